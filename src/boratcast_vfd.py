@@ -1,43 +1,156 @@
+import asyncio
+
+SPACE = 0x20
+
+def clamp(x, l, u):
+    return l if x < l else u if x > u else x
+
+
+# Device independent model of what the displays show: a line of character
+# codes, the cursor and the indicator icons (3 bytes at grid icons_pos of the
+# PT6315, other displays ignore them). The character stream is interpreted
+# here once, terminals only encode and transmit the result.
+class Frame:
+    def __init__(self, width):
+        self.width = width
+        self.cells = bytearray(b' ' * width)
+        self.cursor = 0
+        self.shifts = 0         # number of scrolls so far, lets narrower views follow the text
+        self.low = 0            # leftmost cursor position since the last render
+        self.icons = bytearray(3)
+        self.icons_pos = -1
+
+    def cls(self):
+        cells = self.cells
+        for i in range(self.width):
+            cells[i] = SPACE
+        self.cursor = 0
+        self.low = 0
+
+    def setpos(self, n):
+        self.cursor = clamp(n, 0, self.width - 1)
+        if self.cursor < self.low:
+            self.low = self.cursor
+
+    def putchar(self, c):
+        if c == '\n' or c == '\r':
+            self.cursor = 0
+            self.low = 0
+            return
+        elif c == '\014':   # ^L form feed
+            self.cls()
+            return
+        elif c == '\010': # ^H backspace
+            if self.cursor > 0:
+                self.cursor -= 1
+            if self.cursor < self.low:
+                self.low = self.cursor
+            return
+
+        code = ord(c)
+        self.putcode(code if code < 256 else SPACE)
+
+    # write character code at the cursor
+    def putcode(self, code):
+        # auto scroll
+        cells = self.cells
+        if self.cursor >= self.width:
+            for i in range(self.width - 1):
+                cells[i] = cells[i + 1]
+            self.cursor -= 1
+            self.shifts += 1
+            if self.low > 0:
+                self.low -= 1
+
+        cells[self.cursor] = code
+        self.cursor += 1
+
+
+# Window of a frame shown by a terminal narrower than the frame. The window
+# scrolls with the text and follows the cursor, so every display scrolls the
+# same way as a terminal of its own width would.
+class View:
+    def __init__(self, width):
+        self.width = width
+        self.origin = 0
+        self._shifts = 0
+
+    def update(self, frame):
+        o = self.origin - (frame.shifts - self._shifts)
+        self._shifts = frame.shifts
+        if frame.low < o:
+            o = frame.low
+        c = frame.cursor
+        if c > o + self.width:
+            o = c - self.width
+        self.origin = clamp(o, 0, frame.width - self.width)
+        return self.origin
+
+
 class Boratcast:
     _terms = []
+    _writer = None
     
-    def __init__(self, terms):
+    def __init__(self, terms, width=None):
         self._terms = terms
+        if width is None:
+            width = max(t.width() for t in terms)
+        self._frame = Frame(width)
+        self._views = [View(t.width()) for t in terms]
+
+    def frame(self):
+        return self._frame
+
+    # flush() hands the frame over to writer (a DisplayWriter), None to write in place
+    def attach(self, writer):
+        self._writer = writer
         
     def cls(self, flush=True):
-        for t in self._terms:
-            t.cls(flush)
+        self._frame.cls()
+        if flush:
+            self.flush()
 
     def flush(self):
-        for t in self._terms:
-            t.flush()
+        if self._writer is not None:
+            self._writer.publish()
+        else:
+            self.render()
+
+    # send the frame to every terminal now
+    def render(self):
+        frame = self._frame
+        views = self._views
+        terms = self._terms
+        for i in range(len(terms)):
+            terms[i].render(frame, views[i].update(frame))
+        frame.low = frame.cursor
 
     def home(self):
-        for t in self._terms:
-            t.home()
+        self._frame.putchar('\r')
 
     def pos(self) -> int:
-        p = 0
-        for t in self._terms:
-            return t.pos()
-        return p
+        return self._frame.cursor
     
     def setpos(self, n):
-        for t in self._terms:
-            t.setpos(n)
+        self._frame.setpos(n)
     
-    # write glyph (3 bytes) directly at position pos
+    # set the indicator icons (3 bytes) at position pos
     def direct(self, pos, glyph):
-        for t in self._terms:
-            t.direct(pos, glyph)
+        frame = self._frame
+        frame.icons_pos = pos
+        for i in range(3):
+            frame.icons[i] = glyph[i]
+        self.flush()
 
     def putchar(self, c):
-        for t in self._terms:
-            t.putchar(c)
+        self._frame.putchar(c)
 
     def puts(self, s, flush=True):
-        for t in self._terms:
-            t.puts(s, flush=flush)
+        frame = self._frame
+        for c in s:
+            frame.putchar(c)
+        if flush:
+            self.flush()
 
     def begin(self):
         for t in self._terms:
@@ -54,4 +167,45 @@ class Boratcast:
     def setDisplay(self, on):
         for t in self._terms:
             t.setDisplay(on)
-    
\ No newline at end of file
+
+
+# Writes the frame of a Boratcast from its own task. Producers only publish,
+# they never wait for the bus. The writer renders whatever the frame is when it
+# wakes up, so frames published in between are dropped and back to back flushes
+# collapse into one. Writes are at least interval_ms apart. With bus (a
+# spibus.SPIBus) the writer waits for the bus without blocking the event loop
+# while a _thread worker has it.
+# The writer polls a flag every interval_ms rather than waiting on an Event:
+# Event.wait() and 'async with' create a coroutine per frame, sleep_ms() with
+# an int allocates nothing, so a published frame reaches the displays without
+# touching the heap.
+class DisplayWriter:
+    def __init__(self, vfd, interval_ms=20, bus=None):
+        self._vfd = vfd
+        self._interval_ms = interval_ms
+        self._bus = bus
+        self._pending = False
+        self.published = 0
+        self.written = 0
+
+    def publish(self):
+        self.published += 1
+        self._pending = True
+
+    async def run(self):
+        bus = self._bus
+        while True:
+            await asyncio.sleep_ms(self._interval_ms)
+            if not self._pending:
+                continue
+            self._pending = False
+            if bus is not None:
+                while not bus.try_acquire():
+                    await asyncio.sleep_ms(0)
+                try:
+                    self._vfd.render()
+                finally:
+                    bus.release()
+            else:
+                self._vfd.render()
+            self.written += 1
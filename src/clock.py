@@ -0,0 +1,110 @@
+# clock
+#
+# Local time for the clock face. The RTC is read once per sync, in between the
+# time is derived from ticks_ms(), so the clock knows exactly when the display
+# changes next (the colon blinks every half second, the minute rolls over on a
+# second boundary) and can sleep until then.
+import time
+import util
+
+MS_PER_DAY = 86400000
+BLINK_MS = 500              # colon on for the first half of every second
+REANCHOR_MS = 86400 * 1000  # ticks_diff() spans 2**29 ms, move the anchor along before that
+
+# character codes of the clock face, digits of n are at DIGITS[n*2:n*2+2]
+DIGITS = ''.join('%02d' % n for n in range(60)).encode()
+PLACEHOLDER = b'--'
+COLON = 0x3a
+SPACE = 0x20
+
+
+class ClockRenderer:
+    def __init__(self):
+        self.wakeups = 0        # number of draw() calls
+        self.redraws = 0        # number of times the clock face changed
+        self._last = -1
+        self.sync()
+
+    # anchor to the RTC, call after the RTC or util.TZ_OFFSET changes
+    def sync(self):
+        ns = time.time_ns()
+        self._t0 = time.ticks_ms()
+        self._ms0 = (ns // 1000000 + util.TZ_OFFSET * 1000) % MS_PER_DAY
+
+    # local time in milliseconds since midnight
+    def ms(self):
+        dt = time.ticks_diff(time.ticks_ms(), self._t0)
+        if dt >= REANCHOR_MS:
+            # not from the RTC, it may only count whole seconds and the colon
+            # and minute would lose their phase; ticks_ms() runs from the same
+            # crystal, so it is just as good
+            self._t0 = time.ticks_add(self._t0, dt)
+            self._ms0 = (self._ms0 + dt) % MS_PER_DAY
+            dt = 0
+        return (self._ms0 + dt) % MS_PER_DAY
+
+    # milliseconds until the clock face changes
+    def ms_to_change(self, ms=None):
+        if ms is None:
+            ms = self.ms()
+        return BLINK_MS - ms % BLINK_MS
+
+    # draw the clock face if it changed, returns the number of ms until the next change
+    def draw(self, vfd, time_is_set):
+        self.wakeups += 1
+        ms = self.ms()
+        hour = ms // 3600000
+        minute = ms // 60000 % 60
+        colon = ms % 1000 < BLINK_MS
+        face = (hour * 60 + minute) * 2 + colon if time_is_set else -2 - colon
+        if face != self._last:
+            self._last = face
+            self.redraws += 1
+            self._put(vfd.frame(), hour, minute, colon, time_is_set)
+            vfd.flush()
+        return self.ms_to_change(ms)
+
+    # same as vfd.puts('\014%02d:%02d'), straight from the code tables
+    def _put(self, frame, hour, minute, colon, time_is_set):
+        frame.cls()
+        if time_is_set:
+            frame.putcode(DIGITS[hour * 2])
+            frame.putcode(DIGITS[hour * 2 + 1])
+        else:
+            frame.putcode(PLACEHOLDER[0])
+            frame.putcode(PLACEHOLDER[1])
+        frame.putcode(COLON if colon else SPACE)
+        if time_is_set:
+            frame.putcode(DIGITS[minute * 2])
+            frame.putcode(DIGITS[minute * 2 + 1])
+        else:
+            frame.putcode(PLACEHOLDER[0])
+            frame.putcode(PLACEHOLDER[1])
+
+    def hour(self):
+        return self.ms() // 3600000
+
+    # force the next draw()
+    def invalidate(self):
+        self._last = -1
+
+
+# heap bytes allocated by n clock redraws taking the same way as in main.py:
+# flush() publishes the frame and the running DisplayWriter writes it out.
+# Should be 0 (MicroPython only). The colon alternates, so every redraw
+# changes the face and goes out on the bus.
+#   vfd.attach(writer)
+#   asyncio.create_task(writer.run())
+#   print(await alloc_check(clock, vfd, writer))
+async def alloc_check(renderer, vfd, writer, n=1000):
+    import gc
+    import asyncio
+    gc.collect()
+    before = gc.mem_alloc()
+    for i in range(n):
+        renderer._put(vfd.frame(), 12, 34, i & 1, True)
+        vfd.flush()
+        written = writer.written
+        while writer.written == written:
+            await asyncio.sleep_ms(1)
+    return gc.mem_alloc() - before
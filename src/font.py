@@ -72,19 +72,37 @@ x_degree = 0x8a0700	# degree char, 0xb0
 def map_range(x, in_min, in_max, out_min, out_max):
     return (x - in_min) * (out_max - out_min) // (in_max - in_min) + out_min
 
-def vfd_get_glyph(ch):
-    c = ord(ch)
-    if c == ' ':
-        return 0
-    elif c >= 33 and c <= 96:
+def _glyph(c):
+    if c >= 33 and c <= 96:
         # ! ~ `
         return font[map_range(c, 33, 96, 0, 63)]
     elif c >= 97 and c <= 122:
         # a~z
-        return vfd_get_glyph(chr(c - 32))
+        return _glyph(c - 32)
     elif c == 0xb0:
         return x_degree
     else:
         return 0
+
+def _build_glyphs():
+    g = bytearray(256 * 3)
+    for c in range(256):
+        v = _glyph(c)
+        g[c * 3] = (v >> 16) & 255
+        g[c * 3 + 1] = (v >> 8) & 255
+        g[c * 3 + 2] = v & 255
+    return bytes(g)
+
+# 3 segment bytes for every code point 0..255, glyph of code c is at GLYPHS[c*3:c*3+3]
+GLYPHS = _build_glyphs()
+
+# offset of the glyph of character ch in GLYPHS
+def glyph_offset(ch):
+    c = ord(ch)
+    return c * 3 if c < 256 else 0
+
+def vfd_get_glyph(ch):
+    o = glyph_offset(ch)
+    return (GLYPHS[o] << 16) | (GLYPHS[o + 1] << 8) | GLYPHS[o + 2]
     
 #print(vfd_get_glyph('B'))
@@ -42,11 +42,88 @@ SET_DISPLAT_LIGHT_ON = const(0xE8)
 SET_DISPLAT_LIGHT_OFF = const(0xEA)
 SET_STAND_BY_MODE = const(0xEC)
 
+CGRAM_SLOTS = const(8)
+
+
+# Keeps track of which 5x7 bitmaps are resident in the CGRAM user-character
+# slots. Bitmaps are looked up by a hash of their 5 columns, a bitmap is uploaded
+# only when it is not resident yet, the least recently used slot is evicted.
+# Slots used since begin_frame() are never evicted, so every cell of the frame
+# being drawn keeps its glyph.
+class CGRAMCache:
+    def __init__(self, vfd, nslots=CGRAM_SLOTS):
+        self._vfd = vfd
+        self._nslots = nslots
+        self._index = {}                        # bitmap hash -> slot
+        self._bitmaps = bytearray(5 * nslots)   # resident bitmaps
+        self._hashes = [-1] * nslots            # slot -> bitmap hash, -1 when free
+        self._used = [0] * nslots               # slot -> frame number of last use
+        self._frame = 1
+        self.uploads = 0
+        self.hits = 0
+
+    def begin_frame(self):
+        self._frame += 1
+
+    def _hash(self, buf, off):
+        h = 0
+        for i in range(off, off + 5):
+            h = (h * 131 + buf[i]) & 0xfffffff
+        return h
+
+    # slot holding the bitmap buf[off:off+5], -1 if it's not resident
+    def find(self, buf, off=0):
+        slot = self._index.get(self._hash(buf, off), -1)
+        if slot >= 0:
+            bitmaps = self._bitmaps
+            b = slot * 5
+            for i in range(5):
+                if bitmaps[b + i] != buf[off + i]:
+                    return -1
+            self._used[slot] = self._frame
+            self.hits += 1
+        return slot
+
+    # slot holding the bitmap buf[off:off+5], uploads it if necessary,
+    # -1 when every slot is taken by the current frame
+    def slot(self, buf, off=0):
+        slot = self.find(buf, off)
+        if slot >= 0:
+            return slot
+
+        used = self._used
+        for i in range(self._nslots):
+            if used[i] != self._frame and (slot < 0 or used[i] < used[slot]):
+                slot = i
+        if slot < 0:
+            return -1
+
+        h = self._hash(buf, off)
+        old = self._hashes[slot]
+        if old >= 0 and self._index.get(old) == slot:
+            del self._index[old]
+        self._index[h] = slot
+        self._hashes[slot] = h
+        used[slot] = self._frame
+        bitmaps = self._bitmaps
+        for i in range(5):
+            bitmaps[slot * 5 + i] = buf[off + i]
+        self._vfd.write_cgram(slot, buf, off)
+        self.uploads += 1
+        return slot
+
+    def clear(self):
+        self._index = {}
+        for i in range(self._nslots):
+            self._hashes[i] = -1
+            self._used[i] = 0
+
 
 class VFD(framebuf.FrameBuffer):
 
+    # spi is a spibus.SPIDevice configured for this display:
+    #   baudrate=5000000, polarity=0, phase=0, firstbit=SPI.LSB
     def __init__(self, spi, res, cs, en, digits=8, dimming=255):
-        self.rate = 5000000
         self.digits = digits
         self.dimming = dimming
         res.init(res.OUT, value=0)
@@ -59,6 +136,14 @@ class VFD(framebuf.FrameBuffer):
         self.cs = cs
         self.buffer = bytearray(5 * self.digits)
         super().__init__(self.buffer, 5 * self.digits, 7, framebuf.MONO_VLSB)
+
+        # one CS frame is packed here and sent with a single spi.write,
+        # longest frame is a CGRAM write: command + 5 columns, or a DCRAM burst
+        self._txbuf = bytearray(1 + max(5, self.digits))
+        self._txviews = [memoryview(self._txbuf)[0:n] for n in range(len(self._txbuf) + 1)]
+        self._txlen = 0
+        self._codes = bytearray(self.digits)
+        self.cgram = CGRAMCache(self, min(CGRAM_SLOTS, self.digits))
         import time
 
         # init VFD display
@@ -70,70 +155,106 @@ class VFD(framebuf.FrameBuffer):
         time.sleep_ms(3)
         self.init_display()
 
+    # transaction: the bus is held and configured once for everything written inside
+    #   with vfd:
+    #       ...
+    def __enter__(self):
+        self.spi.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return self.spi.__exit__(exc_type, exc, tb)
+
     def init_display(self):
-        for cmd in (
-                # Set Display timing
-                (SET_DISPLAY_TIMING, self.digits - 1),
-                # Set the URAM (when digits > 16)
-                # Set Display Dimming data
-                (SET_DIMMING_DATA, self.dimming),
-                # Release the All display OFF
-                (SET_DISPLAT_LIGHT_ON, 0x00)
-        ):
-            self.__write_cmd(cmd)
+        with self:
+            # Set Display timing
+            self.__write_cmd(SET_DISPLAY_TIMING, self.digits - 1)
+            # Set the URAM (when digits > 16)
+            # Set Display Dimming data
+            self.__write_cmd(SET_DIMMING_DATA, self.dimming)
+            # Release the All display OFF
+            self.__write_cmd(SET_DISPLAT_LIGHT_ON, 0x00)
 
     def display_clear(self, *address: int):
         if address:
-            self.__write_cmd((DCRAM_DATA_WRITE | address, DGRAM_DATA_CLAER))
+            self.__write_cmd(DCRAM_DATA_WRITE | address[0], DGRAM_DATA_CLAER)
         else:
+            self._put(DCRAM_DATA_WRITE)
             for i in range(self.digits):
-                self.__write_cmd((DCRAM_DATA_WRITE | i, DGRAM_DATA_CLAER))
+                self._put(DGRAM_DATA_CLAER)
+            self._commit()
 
     def display_str(self, address: int, msg: str):
+        # DCRAM address auto-increments, the whole string goes in one frame
+        self._put(DCRAM_DATA_WRITE | address)
         for i in msg:
-            self.__write_cmd((DCRAM_DATA_WRITE | address, ord(i)))
+            self._put(ord(i))
             if address < self.digits - 1:
                 address += 1
             else:
                 break
+        self._commit()
+
+    # write character codes buf[start:end] to DCRAM from address on in one frame
+    def display_codes(self, address: int, buf, start: int, end: int):
+        self._put(DCRAM_DATA_WRITE | address)
+        for i in range(start, min(end, start + self.digits - address)):
+            self._put(buf[i])
+        self._commit()
 
     def display_custom(self, address: int, buf: bytearray):
-        self.__write_data(address, buf)
-        self.__write_cmd((DCRAM_DATA_WRITE | address, address))
+        with self:
+            self.cgram.begin_frame()
+            slot = self.cgram.slot(buf)
+            if slot >= 0:
+                self.__write_cmd(DCRAM_DATA_WRITE | address, slot)
+
+    # upload the 5 columns buf[off:off+5] to CGRAM slot
+    def write_cgram(self, slot: int, buf, off: int = 0):
+        self._put(CGRAM_DATA_WRITE | slot)
+        for i in range(off, off + 5):
+            self._put(buf[i])
+        self._commit()
 
     def show(self):
-        buf = bytearray(5)
-        fbuf = framebuf.FrameBuffer(buf, 5, 7, framebuf.MONO_VLSB)
-        for i in range(self.digits):
-            fbuf.fill(0)
-            fbuf.blit(self, 0 - (i * 5), 0)
-            self.__write_data(i, buf)
-        for i in range(self.digits):
-            self.__write_cmd((DCRAM_DATA_WRITE | i, i))
+        # MONO_VLSB: the framebuffer is one byte per column, digit i is buffer[i*5:i*5+5]
+        cache = self.cgram
+        codes = self._codes
+        with self:
+            cache.begin_frame()
+            # pin the resident digits first so that uploads don't evict them
+            for i in range(self.digits):
+                codes[i] = cache.find(self.buffer, i * 5) & 0xff
+            for i in range(self.digits):
+                if codes[i] == 0xff:
+                    codes[i] = cache.slot(self.buffer, i * 5) & 0xff
+            self.display_codes(0, codes, 0, self.digits)
 
     def set_display_dimming(self, dimming: int):
-        dimming_data = dimming
-        self.__write_cmd((SET_DIMMING_DATA, dimming_data))
+        self.dimming = dimming
+        self.__write_cmd(SET_DIMMING_DATA, dimming)
 
     def on(self):
-        self.__write_cmd([SET_STAND_BY_MODE, 0x00])
+        self.__write_cmd(SET_STAND_BY_MODE, 0x00)
 
     def off(self):
-        self.__write_cmd([SET_STAND_BY_MODE | 1, 0x00])
-
-    def __write_cmd(self, cmd):
-        self.spi.init(baudrate=self.rate, polarity=0, phase=0, firstbit=self.spi.LSB)
-        self.cs(1)
-        self.cs(0)
-        for i in cmd:
-            self.spi.write(bytearray([i]))
-        self.cs(1)
-
-    def __write_data(self, address: int, buf):
-        self.spi.init(baudrate=self.rate, polarity=0, phase=0, firstbit=self.spi.LSB)
-        self.cs(1)
-        self.cs(0)
-        self.spi.write(bytearray([CGRAM_DATA_WRITE | address]))
-        for i in buf:
-            self.spi.write(bytearray([i]))
-        self.cs(1)
+        self.__write_cmd(SET_STAND_BY_MODE | 1, 0x00)
+
+    def _put(self, b):
+        self._txbuf[self._txlen] = b
+        self._txlen += 1
+
+    # send the packed frame with one CS assertion
+    def _commit(self):
+        with self:
+            self.cs(1)
+            self.cs(0)
+            self.spi.write(self._txviews[self._txlen])
+            self.cs(1)
+        self._txlen = 0
+
+    def __write_cmd(self, cmd, data):
+        self._put(cmd)
+        self._put(data)
+        self._commit()
+
@@ -1,74 +1,90 @@
 from futaba_8md06inkm import VFD
 
 NCHARS = 8
+SPACE = 0x20
 
-def clamp(x, l, u):
-    return l if x < l else u if x > u else x
-
+# Output of a boratcast_vfd.Boratcast, which interprets the text and control
+# codes once for all terminals and hands over the frame to render()
 class Term:
     def __init__(self, drv):
         self._drv = drv
-        self._cursoraddr = 0
-        self._lastaddr = 0
-        self._buffer = [' '] * NCHARS
-        
-    def cls(self, flush=True):
-        self._buffer[:] = [' '] * NCHARS
-        self._cursoraddr = 0
-        self._lastaddr = 0
-        if flush:
-            self._drv.display_clear()
+        # character codes of the frame being drawn and of what the controller shows
+        self._buffer = bytearray(b' ' * NCHARS)
+        self._shown = bytearray(NCHARS)
+        # codes sent to the controller: _buffer with custom glyphs replaced by CGRAM slots
+        self._out = bytearray(NCHARS)
+        self._custom = {}   # character code -> 5 column bitmap
+        self.invalidate()
 
-    def flush(self):
-        self._drv.display_str(0, self._buffer)
+    # use the 5x7 bitmap (5 bytes, one per column, LSB at the top) for character c
+    def define(self, c, bitmap):
+        self._custom[ord(c)] = bytes(bitmap)
+        self._synced = False
 
-    def home(self):
-        self._cursoraddr = 0
+    # forget what the controller shows, next flush rewrites every cell
+    def invalidate(self):
+        self._synced = False
 
-    def pos(self) -> int:
-        return self._cursoraddr
-    
-    def setpos(self, n):
-        self._cursoraddr = clamp(n, 0, NCHARS-1)
-    
-    # write glyph (3 bytes) directly at position pos
-    def direct(self, pos, glyph):
-        # this causes all kinds of messy trouble
-        
-        #self._drv.display_str(pos, [chr(glyph[0])])
-        pass
+    # map custom characters to CGRAM slots, uploading the bitmaps that aren't resident
+    def _map_custom(self):
+        buf = self._buffer
+        out = self._out
+        custom = self._custom
+        cache = self._drv.cgram
+        cache.begin_frame()
+        missing = False
+        for i in range(NCHARS):
+            c = buf[i]
+            bitmap = custom.get(c)
+            if bitmap is None:
+                out[i] = c
+            else:
+                slot = cache.find(bitmap)
+                missing |= slot < 0
+                out[i] = slot & 0xff
+        if missing:
+            with self._drv:
+                for i in range(NCHARS):
+                    if out[i] == 0xff and buf[i] in custom:
+                        slot = cache.slot(custom[buf[i]])
+                        out[i] = slot if slot >= 0 else SPACE
+        return out
 
-    def putchar(self, c):
-        if c == '\n' or c == '\r':
-            self.home()
-            return
-        elif c == '\014':   # ^L form feed
-            self.cls(flush=False)
-            return
-        elif c == '\010': # ^H backspace
-            self.setpos(self.pos() - 1)
-            return
-        
-        if c == '\xb0': # degree char
-            c = '\xef'
-        
-        # auto scroll
-        self.autoscroll()
-
-        self._lastaddr = self._cursoraddr
-        self._buffer[self.pos()] = c
-        self._cursoraddr += 1
+    def flush(self):
+        out = self._map_custom() if self._custom else self._buffer
+        shown = self._shown
+        i = 0
+        if self._synced:
+            while i < NCHARS and out[i] == shown[i]:
+                i += 1
+            if i == NCHARS:
+                return
+        with self._drv:
+            # one DCRAM burst per run of changed cells
+            while i < NCHARS:
+                if self._synced and out[i] == shown[i]:
+                    i += 1
+                    continue
+                j = i + 1
+                while j < NCHARS and (not self._synced or out[j] != shown[j]):
+                    j += 1
+                self._drv.display_codes(i, out, i, j)
+                for k in range(i, j):
+                    shown[k] = out[k]
+                i = j
+        self._synced = True
 
-    def puts(self, s, flush=True):
-        for c in s:
-            self.putchar(c)
-        if flush:
-            self.flush()
+    def width(self) -> int:
+        return NCHARS
 
-    def autoscroll(self):
-        if self._cursoraddr >= NCHARS:
-            self._buffer[0:NCHARS-1] = self._buffer[1:NCHARS]
-            self._cursoraddr -= 1        
+    # show frame.cells[origin:origin+NCHARS] (see boratcast_vfd.Frame)
+    def render(self, frame, origin):
+        buf = self._buffer
+        cells = frame.cells
+        for i in range(NCHARS):
+            code = cells[origin + i]
+            buf[i] = 0xef if code == 0xb0 else code     # degree char
+        self.flush()
 
     def begin(self):
         pass
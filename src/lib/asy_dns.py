@@ -0,0 +1,152 @@
+#
+# asy_dns.py
+#
+# DNS resolver for uasyncio. socket.getaddrinfo() blocks the whole event loop
+# until the answer comes; this one sends the query over UDP with AsyUDPClient
+# and waits on the poller. Answers are cached for their TTL. When the server
+# does not answer, an expired answer is still better than none and is used.
+#
+#   ip = await resolve('wttr.in')
+#
+import time
+import random
+import struct
+
+from asy_udp_client import AsyUDPClient
+
+DNS_PORT = 53
+FALLBACK_SERVER = '8.8.8.8'
+MIN_TTL = 60            # seconds, to spare the radio when TTLs are tiny
+MAX_TTL = 86400         # ticks_ms() must not wrap meanwhile
+TIMEOUT_MS = 1000
+TRIES = 3
+
+
+def is_ip(host):
+    parts = host.split('.')
+    return len(parts) == 4 and all(p.isdigit() and int(p) < 256 for p in parts)
+
+
+# DNS server from the station interface
+def _server():
+    try:
+        import network
+        return network.WLAN(network.STA_IF).ifconfig()[3]
+    except Exception:
+        return FALLBACK_SERVER
+
+
+def _query(qid, host):
+    q = bytearray(struct.pack('!HHHHHH', qid, 0x0100, 1, 0, 0, 0))  # recursion desired, 1 question
+    for label in host.split('.'):
+        q.append(len(label))
+        q.extend(label.encode())
+    q.extend(b'\0\0\1\0\1')     # root, type A, class IN
+    return q
+
+
+# offset after the name at msg[i], compressed or not
+def _skip_name(msg, i):
+    while True:
+        n = msg[i]
+        if n == 0:
+            return i + 1
+        if n & 0xc0 == 0xc0:
+            return i + 2
+        i += n + 1
+
+
+# (ip, ttl) of the first A record in the answer, raises OSError
+def _parse(msg):
+    qid, flags, qdcount, ancount = struct.unpack_from('!HHHH', msg, 0)
+    if flags & 0x000f:
+        raise OSError('DNS error %d' % (flags & 0x000f))
+    i = 12
+    for _ in range(qdcount):
+        i = _skip_name(msg, i) + 4
+    for _ in range(ancount):
+        i = _skip_name(msg, i)
+        rtype, rclass, ttl, rdlength = struct.unpack_from('!HHIH', msg, i)
+        i += 10
+        if rtype == 1 and rclass == 1 and rdlength == 4:
+            return '%d.%d.%d.%d' % tuple(msg[i:i + 4]), ttl
+        i += rdlength
+    raise OSError('no A record')
+
+
+class Resolver:
+    def __init__(self, server=None, timeout_ms=TIMEOUT_MS, tries=TRIES):
+        self.server = server
+        self.timeout_ms = timeout_ms
+        self.tries = tries
+        self._cache = {}        # host -> [ip, ticks_ms when it expires]
+        self.hits = 0
+        self.queries = 0
+        self.stale = 0          # expired answers used because the server failed
+        self.failures = 0
+
+    # IPv4 address of host as a string, raises OSError
+    async def resolve(self, host):
+        if is_ip(host):
+            return host
+        entry = self._cache.get(host)
+        if entry is not None and time.ticks_diff(entry[1], time.ticks_ms()) > 0:
+            self.hits += 1
+            return entry[0]
+        try:
+            ip, ttl = await self._lookup(host)
+        except OSError:
+            self.failures += 1
+            if entry is None:
+                raise
+            self.stale += 1
+            return entry[0]
+        ttl = min(max(ttl, MIN_TTL), MAX_TTL)
+        self._cache[host] = [ip, time.ticks_add(time.ticks_ms(), ttl * 1000)]
+        return ip
+
+    async def _lookup(self, host):
+        self.queries += 1
+        qid = random.getrandbits(16)
+        cli = AsyUDPClient((self.server or _server(), DNS_PORT), rx_timeout_ms=self.timeout_ms)
+        try:
+            msg = await cli.send_and_receive(_query(qid, host), tries=self.tries,
+                                             match=lambda r: len(r) >= 12 and r[0] << 8 | r[1] == qid)
+        finally:
+            await cli.disconnect()
+        if msg is None:
+            raise OSError('DNS timeout: ' + host)
+        try:
+            return _parse(msg)
+        except OSError:
+            raise
+        except Exception:
+            # truncated or malformed, callers only expect OSError
+            raise OSError('bad DNS reply: ' + host)
+
+    # (ip, port) for socket.connect(), like getaddrinfo(host, port)[0][-1]
+    async def getaddr(self, host, port):
+        return (await self.resolve(host), port)
+
+    def flush(self):
+        self._cache = {}
+
+    def stats(self):
+        return {
+            'cached': len(self._cache),
+            'hits': self.hits,
+            'queries': self.queries,
+            'stale': self.stale,
+            'failures': self.failures,
+        }
+
+
+resolver = Resolver()
+
+
+async def resolve(host):
+    return await resolver.resolve(host)
+
+
+async def getaddr(host, port):
+    return await resolver.getaddr(host, port)
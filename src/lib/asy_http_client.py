@@ -0,0 +1,359 @@
+#
+# asy_http_client.py
+#
+# Minimal HTTP/1.1 GET for uasyncio. The body is not buffered, it is handed
+# to a callback chunk by chunk as it arrives.
+#
+#   status = await get('https://wttr.in/Paris?format=%t', parser.feed)
+#
+# Requests go through a Pool that keeps the connection to each host open
+# between requests (keep-alive), so a batch of requests to one host pays for
+# DNS, TCP connect and the TLS handshake once. MicroPython's ssl has no TLS
+# session resumption, an idle connection is the only session that can be
+# reused. Idle TLS connections hold mbedTLS buffers, so whoever is done with
+# a batch should call pool.close().
+#
+# Every request records its timings in pool.last, totals are in pool.stats().
+#
+# get(..., gzip=True) asks for a gzip-compressed body when the deflate module
+# is there. deflate cannot be fed piece by piece, so the compressed body is
+# collected first and then inflated into a CHUNK_SIZE window for on_data.
+# Bodies up to GZIP_MAX_BODY are collected, chunked ones included. For a
+# larger body, or one that lasts until the server closes, the request is
+# repeated without gzip. Inflating needs the full 32 KB gzip window on the
+# heap on top of that, so the peak is well above the plain CHUNK_SIZE
+# streaming path; pool.stats()['heap_peak'] tells by how much.
+#
+import uasyncio as asyncio
+import gc
+import io
+import time
+import asy_dns
+try:
+    import deflate
+except ImportError:
+    deflate = None
+
+CHUNK_SIZE = 256
+IDLE_MS = 30000         # idle connections older than this are not reused
+GZIP_WBITS = 15         # gzip does not tell the window size, servers use the largest
+GZIP_MAX_BODY = 8192    # largest compressed body that is collected
+
+
+def parse_url(url):
+    scheme, _, rest = url.partition('://')
+    hostport, slash, path = rest.partition('/')
+    host, _, port = hostport.partition(':')
+    if scheme == 'https':
+        return host, int(port) if port else 443, '/' + path, True
+    elif scheme == 'http':
+        return host, int(port) if port else 80, '/' + path, False
+    raise ValueError('unsupported scheme: ' + scheme)
+
+
+# heap in use, -1 where gc can't tell
+def _heap():
+    return gc.mem_alloc() if hasattr(gc, 'mem_alloc') else -1
+
+
+# Milliseconds spent in each phase of one request, -1 for phases skipped on a
+# reused connection. The handshake is the first write on a new TLS connection.
+# nbytes is the body size on the wire, inflated its size after gzip (-1 if it
+# was not compressed), heap the largest heap use seen during the request.
+class Timing:
+    def __init__(self, reused):
+        self.reused = reused
+        self.dns = -1
+        self.connect = -1
+        self.handshake = -1
+        self.first_byte = -1
+        self.total = -1
+        self.nbytes = 0
+        self.inflated = -1
+        self.heap = _heap()
+
+    def sample_heap(self):
+        h = _heap()
+        if h > self.heap:
+            self.heap = h
+
+    def __repr__(self):
+        return 'dns=%d connect=%d handshake=%d first_byte=%d total=%d reused=%s bytes=%d inflated=%d heap=%d' % (
+            self.dns, self.connect, self.handshake, self.first_byte, self.total, self.reused,
+            self.nbytes, self.inflated, self.heap)
+
+
+class Connection:
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.requests = 0
+        self.idle_since = time.ticks_ms()
+
+    async def close(self):
+        try:
+            self.writer.close()
+            await self.writer.wait_closed()
+        except Exception:
+            pass
+
+
+class Pool:
+    def __init__(self, idle_ms=IDLE_MS):
+        self._idle_ms = idle_ms
+        self._idle = {}         # (host, port, tls) -> Connection
+        self._ssl = None
+        self.last = None        # Timing of the last request
+        self.requests = 0
+        self.reused = 0
+        self.connects = 0
+        self.handshake_ms = 0   # total time spent in TLS handshakes
+        self.first_byte_ms = 0  # total time from request to status line
+        self.nbytes = 0         # body bytes received
+        self.inflated = 0       # body bytes after inflating the compressed ones
+        self.heap_peak = -1     # largest Timing.heap
+
+    def _ssl_context(self):
+        if self._ssl is None:
+            import ssl
+            self._ssl = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            self._ssl.verify_mode = ssl.CERT_NONE
+        return self._ssl
+
+    # idle connection to key, None if there is none or it has been idle too long
+    async def _take(self, key):
+        conn = self._idle.pop(key, None)
+        if conn is not None and time.ticks_diff(time.ticks_ms(), conn.idle_since) > self._idle_ms:
+            await conn.close()
+            conn = None
+        return conn
+
+    async def _connect(self, key, timing, timeout_ms):
+        host, port, tls = key
+        t = time.ticks_ms()
+        ip = await asy_dns.resolve(host)
+        t1 = time.ticks_ms()
+        timing.dns = time.ticks_diff(t1, t)
+        if tls:
+            reader, writer = await asyncio.wait_for_ms(
+                asyncio.open_connection(ip, port, ssl=self._ssl_context(), server_hostname=host), timeout_ms)
+        else:
+            reader, writer = await asyncio.wait_for_ms(asyncio.open_connection(ip, port), timeout_ms)
+        timing.connect = time.ticks_diff(time.ticks_ms(), t1)
+        self.connects += 1
+        return Connection(key, reader, writer)
+
+    # GET url, see get() below
+    async def get(self, url, on_data, connect_timeout_ms=10000, read_timeout_ms=10000, gzip=False):
+        try:
+            return await self._get(url, on_data, connect_timeout_ms, read_timeout_ms, gzip)
+        except _NoGzip:
+            return await self._get(url, on_data, connect_timeout_ms, read_timeout_ms, False)
+
+    async def _get(self, url, on_data, connect_timeout_ms, read_timeout_ms, gzip):
+        host, port, path, tls = parse_url(url)
+        key = (host, port, tls)
+        request = b'GET %s HTTP/1.1\r\nHost: %s\r\n%s\r\n' % (
+            path.encode(), host.encode(), b'Accept-Encoding: gzip\r\n' if gzip and deflate else b'')
+        self.requests += 1
+        t0 = time.ticks_ms()
+
+        conn = await self._take(key)
+        if conn is not None:
+            # the server may have closed it meanwhile, then try once more on a new connection
+            timing = Timing(True)
+            try:
+                status = await self._exchange(conn, request, on_data, timing, read_timeout_ms, True)
+                self.reused += 1
+                return self._done(conn, status, timing, t0)
+            except _Stale:
+                await conn.close()
+            except BaseException:
+                await conn.close()
+                raise
+
+        timing = Timing(False)
+        conn = await self._connect(key, timing, connect_timeout_ms)
+        try:
+            status = await self._exchange(conn, request, on_data, timing, read_timeout_ms, False)
+        except BaseException:
+            await conn.close()
+            raise
+        return self._done(conn, status, timing, t0)
+
+    def _done(self, conn, status, timing, t0):
+        timing.total = time.ticks_diff(time.ticks_ms(), t0)
+        if timing.handshake > 0:
+            self.handshake_ms += timing.handshake
+        self.first_byte_ms += timing.first_byte
+        self.nbytes += timing.nbytes
+        self.inflated += timing.nbytes if timing.inflated < 0 else timing.inflated
+        if timing.heap > self.heap_peak:
+            self.heap_peak = timing.heap
+        self.last = timing
+        return status
+
+    # send request, read the response, put conn back to the pool if it can be reused
+    async def _exchange(self, conn, request, on_data, timing, timeout_ms, reused):
+        reader = conn.reader
+        t = time.ticks_ms()
+        try:
+            conn.writer.write(request)
+            await asyncio.wait_for_ms(conn.writer.drain(), timeout_ms)
+            if not reused and conn.key[2]:
+                timing.handshake = time.ticks_diff(time.ticks_ms(), t)
+            line = await asyncio.wait_for_ms(reader.readline(), timeout_ms)
+        except OSError:
+            if reused:
+                raise _Stale()
+            raise
+        if not line and reused:
+            raise _Stale()
+        timing.first_byte = time.ticks_diff(time.ticks_ms(), t)
+
+        parts = line.split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith(b'HTTP/'):
+            raise OSError('bad status line: %r' % line)
+        status = int(parts[1])
+        keep_alive = parts[0] == b'HTTP/1.1'
+
+        # headers
+        length = -1
+        chunked = False
+        gzipped = False
+        while True:
+            line = await asyncio.wait_for_ms(reader.readline(), timeout_ms)
+            if not line or line == b'\r\n':
+                break
+            name, _, value = line.partition(b':')
+            name = name.strip().lower()
+            value = value.strip().lower()
+            if name == b'content-length':
+                length = int(value)
+            elif name == b'transfer-encoding':
+                chunked = value == b'chunked'
+            elif name == b'content-encoding':
+                gzipped = value == b'gzip'
+                if gzipped and deflate is None:
+                    raise OSError('gzip not supported')
+            elif name == b'connection':
+                keep_alive = value == b'keep-alive' or (keep_alive and value != b'close')
+
+        sink = on_data
+        if gzipped:
+            if length > GZIP_MAX_BODY or (length < 0 and not chunked):
+                # too large or unknown until the server closes, the body is left unread
+                raise _NoGzip()
+            compressed = io.BytesIO()
+            sink = compressed.write
+
+        if chunked:
+            while True:
+                line = await asyncio.wait_for_ms(reader.readline(), timeout_ms)
+                n = int(line.split(b';', 1)[0], 16)
+                if n == 0:
+                    # trailers
+                    while line and line != b'\r\n':
+                        line = await asyncio.wait_for_ms(reader.readline(), timeout_ms)
+                    break
+                if gzipped and timing.nbytes + n > GZIP_MAX_BODY:
+                    raise _NoGzip()
+                timing.nbytes += await _read_body(reader, n, sink, timeout_ms)
+                await asyncio.wait_for_ms(reader.readline(), timeout_ms)
+        elif length >= 0:
+            timing.nbytes += await _read_body(reader, length, sink, timeout_ms)
+        else:
+            # until the server closes the connection
+            keep_alive = False
+            timing.nbytes += await _read_body(reader, -1, sink, timeout_ms)
+        timing.sample_heap()
+
+        if gzipped and timing.nbytes:
+            compressed.seek(0)
+            timing.inflated = _inflate(compressed, on_data, timing)
+            compressed = None
+
+        conn.requests += 1
+        if keep_alive:
+            old = self._idle.pop(conn.key, None)
+            if old is not None:
+                await old.close()
+            conn.idle_since = time.ticks_ms()
+            self._idle[conn.key] = conn
+        else:
+            await conn.close()
+        return status
+
+    # close all idle connections
+    async def close(self):
+        idle = self._idle
+        self._idle = {}
+        for conn in idle.values():
+            await conn.close()
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'reused': self.reused,
+            'connects': self.connects,
+            'idle': len(self._idle),
+            'handshake_ms': self.handshake_ms,
+            'first_byte_ms_avg': self.first_byte_ms // self.requests if self.requests else 0,
+            'bytes': self.nbytes,
+            'inflated': self.inflated,
+            'heap_peak': self.heap_peak,
+        }
+
+
+# a reused connection turned out to be closed by the server
+class _Stale(Exception):
+    pass
+
+
+# a gzip body that can't be collected, ask again for the identity encoding
+class _NoGzip(Exception):
+    pass
+
+
+# hand n bytes of the body (all until EOF if n < 0) to on_data, returns the number of bytes
+async def _read_body(reader, n, on_data, timeout_ms):
+    total = 0
+    while n != 0:
+        chunk = await asyncio.wait_for_ms(reader.read(CHUNK_SIZE if n < 0 else min(n, CHUNK_SIZE)), timeout_ms)
+        if not chunk:
+            if n > 0:
+                raise OSError('connection closed')
+            break
+        on_data(chunk)
+        total += len(chunk)
+        if n > 0:
+            n -= len(chunk)
+    return total
+
+
+# inflate the gzip stream compressed into a CHUNK_SIZE window for on_data,
+# returns the inflated size
+def _inflate(compressed, on_data, timing):
+    window = bytearray(CHUNK_SIZE)
+    view = memoryview(window)
+    total = 0
+    with deflate.DeflateIO(compressed, deflate.GZIP, GZIP_WBITS) as f:
+        while True:
+            n = f.readinto(window)
+            if not n:
+                break
+            timing.sample_heap()
+            on_data(view[0:n])
+            total += n
+    return total
+
+
+pool = Pool()
+
+
+# GET url through the shared pool, on_data(chunk) is called with every piece of
+# the body as it arrives. Returns the HTTP status code, raises OSError or
+# asyncio.TimeoutError.
+async def get(url, on_data, connect_timeout_ms=10000, read_timeout_ms=10000, gzip=False):
+    return await pool.get(url, on_data, connect_timeout_ms, read_timeout_ms, gzip)
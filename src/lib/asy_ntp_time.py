@@ -1,46 +1,217 @@
 #
 # asy_ntptime.py
 #
+# NTP client: every sync queries several servers at once and takes the sample
+# with the shortest round trip. Offset and delay come from all four
+# timestamps (originate t1, receive t2, transmit t3, arrival t4):
+#   offset = ((t2 - t1) + (t3 - t4)) / 2
+#   delay  = (t4 - t1) - (t3 - t2)
+# Times are integer milliseconds since the epoch. Local time is ticks_ms()
+# counted from an anchor: the RTC when the client starts, then the moment the
+# client itself set the RTC, exactly on a second boundary. The RTC may only
+# count whole seconds, but an error in the first anchor cancels out of the
+# time that gets set, since t1, t4 and the setting all read the same clock.
+# The RTC and ticks_ms() run from the same crystal, so the anchor stays valid,
+# but only for ANCHOR_MAX_MS: after a long time without a sync (no network),
+# the RTC is the anchor again.
+#
+# The offset found at a sync is what the RTC drifted since it was last set,
+# which gives its drift rate. The next sync is scheduled when the drift adds
+# up to target_error_ms.
+#
+#   ntp = NTPClient()
+#   while True:
+#       await ntp.sync()
+#       await asyncio.sleep(ntp.interval)
+#
 import time
 import struct
 import uasyncio as asyncio
-import socket
 
+import asy_dns
 from asy_udp_client import AsyUDPClient
 
 # The NTP host can be configured at runtime by doing: ntptime.host = 'myhost.org'
 _host = "pool.ntp.org"
+HOSTS = ("0.pool.ntp.org", "1.pool.ntp.org", "2.pool.ntp.org")
 
-async def asy_ntp_time(host=_host):
-    NTP_QUERY = bytearray(48)
-    NTP_QUERY[0] = 0x1B
-    addr = socket.getaddrinfo(host, 123)[0][-1]
+TARGET_ERROR_MS = 250       # resync before the RTC is off by more than this
+MIN_INTERVAL = 900          # seconds between syncs
+MAX_INTERVAL = 86400
+RETRY_INTERVAL = 60         # after a failed sync
+MIN_DRIFT_SPAN = 600        # seconds since the last set needed to estimate drift
+ANCHOR_MAX_MS = 1 << 28     # ticks_diff() spans 2**29 ms, older anchors are taken from the RTC again
+MAX_DRIFT_PPM = 500         # a larger offset is not drift, e.g. the RTC was set by someone else
 
-    print("addr:", addr)
+EPOCH_YEAR = time.gmtime(0)[0]
+if EPOCH_YEAR == 2000:
+    # (date(2000, 1, 1) - date(1900, 1, 1)).days * 24*60*60
+    NTP_DELTA = 3155673600
+elif EPOCH_YEAR == 1970:
+    # (date(1970, 1, 1) - date(1900, 1, 1)).days * 24*60*60
+    NTP_DELTA = 2208988800
+else:
+    raise Exception("Unsupported epoch: {}".format(EPOCH_YEAR))
 
-    cli = AsyUDPClient(addr)
 
-    tsk = asyncio.create_task(cli.send_and_receive(NTP_QUERY))
-    msg = await tsk
+# NTP timestamp at buf[i:i+8] in ms since the epoch
+def _ntp_ms(buf, i):
+    sec, frac = struct.unpack_from("!II", buf, i)
+    return (sec - NTP_DELTA) * 1000 + (frac * 1000 >> 32)
 
-    if msg is None:
-        print("asy_ntp_time returns None")
-        return None
 
-    val = struct.unpack("!I", msg[40:44])[0]
+def _put_ntp_ms(buf, i, ms):
+    struct.pack_into("!II", buf, i, ms // 1000 + NTP_DELTA, (ms % 1000 << 32) // 1000)
+
+
+# Local time in ms: epoch_ms at ticks_ms() == ticks, extended with ticks_ms()
+class LocalClock:
+    def __init__(self):
+        self.anchor()
+
+    # anchor to the RTC, or to epoch_ms at ticks
+    def anchor(self, epoch_ms=None, ticks=None):
+        if epoch_ms is None:
+            ticks = time.ticks_ms()
+            epoch_ms = time.time_ns() // 1000000
+        self.ticks = ticks
+        self.epoch_ms = epoch_ms
+
+    def ms(self, ticks=None):
+        if ticks is None:
+            ticks = time.ticks_ms()
+        return self.epoch_ms + time.ticks_diff(ticks, self.ticks)
+
+
+# One server's answer, ms
+class Sample:
+    def __init__(self, host, offset, delay, stratum):
+        self.host = host
+        self.offset = offset
+        self.delay = delay
+        self.stratum = stratum
+
+    def __repr__(self):
+        return '%s offset=%d delay=%d stratum=%d' % (self.host, self.offset, self.delay, self.stratum)
 
-    EPOCH_YEAR = time.gmtime(0)[0]
-    if EPOCH_YEAR == 2000:
-        # (date(2000, 1, 1) - date(1900, 1, 1)).days * 24*60*60
-        NTP_DELTA = 3155673600
-    elif EPOCH_YEAR == 1970:
-        # (date(1970, 1, 1) - date(1900, 1, 1)).days * 24*60*60
-        NTP_DELTA = 2208988800
-    else:
-        raise Exception("Unsupported epoch: {}".format(EPOCH_YEAR))
 
-    print("asy_ntp_time returns:", val - NTP_DELTA)
-    return val - NTP_DELTA
+class NTPClient:
+    def __init__(self, hosts=HOSTS, target_error_ms=TARGET_ERROR_MS,
+                 min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+        self.hosts = hosts
+        self.target_error_ms = target_error_ms
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval    # seconds until the next sync
+        self._planned = min_interval    # interval after a successful sync
+        self.drift_ppm = None           # RTC rate error, positive when it runs slow
+        self.last = None                # Sample of the last sync
+        self.syncs = 0
+        self.failures = 0
+        self._clock = LocalClock()
+        self._set_ms = None             # true time when the RTC was last set
+
+    # ask host, returns a Sample or None
+    async def query(self, host):
+        try:
+            addr = await asy_dns.getaddr(host, 123)
+        except OSError as e:
+            print("asy_ntp_time:", host, repr(e))
+            return None
+        clock = self._clock
+        query = bytearray(48)
+        query[0] = 0x23     # LI 0, version 4, mode 3 (client)
+        # t1 goes out as the transmit timestamp and comes back as originate
+        t1 = clock.ms()
+        _put_ntp_ms(query, 40, t1)
+        cli = AsyUDPClient(addr)
+        try:
+            msg = await cli.send_and_receive(query, tries=2,
+                                             match=lambda r: len(r) >= 48 and r[24:32] == query[40:48])
+            t4 = clock.ms()
+        finally:
+            await cli.disconnect()
+        if msg is None:
+            return None
+        li, mode, stratum = msg[0] >> 6, msg[0] & 7, msg[1]
+        if li == 3 or mode != 4 or not 1 <= stratum <= 15:
+            return None     # unsynchronized server or kiss-o'-death
+        t2 = _ntp_ms(msg, 32)
+        t3 = _ntp_ms(msg, 40)
+        # an answer to the retry counts from the first send: its delay is longer
+        # and it loses against the other servers' samples
+        return Sample(host, ((t2 - t1) + (t3 - t4)) // 2, (t4 - t1) - (t3 - t2), stratum)
+
+    # query all hosts at once, best Sample or None
+    async def measure(self):
+        clock = self._clock
+        # the age by the RTC, ticks_ms() may have wrapped around since
+        if self._set_ms is None or time.time_ns() // 1000000 - clock.epoch_ms > ANCHOR_MAX_MS:
+            clock.anchor()
+        samples = await asyncio.gather(*[self.query(h) for h in self.hosts])
+        best = None
+        for s in samples:
+            if s is not None and (best is None or s.delay < best.delay):
+                best = s
+        return best
+
+    # measure, set the RTC and plan the next sync; returns the Sample or None
+    async def sync(self):
+        best = await self.measure()
+        if best is None:
+            self.failures += 1
+            self.interval = RETRY_INTERVAL
+            return None
+        now = self._clock.ms() + best.offset
+        self._update_drift(best.offset, now)
+
+        # set the RTC on the next second boundary
+        await asyncio.sleep_ms(1000 - now % 1000)
+        ticks = time.ticks_ms()
+        now = self._clock.ms(ticks) + best.offset
+        settime((now + 500) // 1000)
+        self._clock.anchor(now, ticks)
+        self._set_ms = now
+
+        self.interval = self._planned
+        self.last = best
+        self.syncs += 1
+        return best
+
+    def _update_drift(self, offset, now):
+        if self._set_ms is None:
+            return
+        span = now - self._set_ms
+        if not MIN_DRIFT_SPAN * 1000 <= span <= ANCHOR_MAX_MS:
+            return
+        ppm = offset * 1000000 // span
+        if abs(ppm) > MAX_DRIFT_PPM:
+            return
+        self.drift_ppm = ppm if self.drift_ppm is None else (3 * self.drift_ppm + ppm) // 4
+        # accumulated error reaches target_error_ms after this many seconds,
+        # stretch at most twice the previous interval at a time
+        interval = self.target_error_ms * 1000 // max(abs(self.drift_ppm), 1)
+        interval = min(interval, 2 * self._planned, self.max_interval)
+        self._planned = max(interval, self.min_interval)
+
+    def stats(self):
+        return {
+            'syncs': self.syncs,
+            'failures': self.failures,
+            'interval': self.interval,
+            'drift_ppm': self.drift_ppm,
+            'last': self.last,
+        }
+
+
+# time from host in seconds since the epoch, None if it did not answer
+async def asy_ntp_time(host=_host):
+    ntp = NTPClient((host,))
+    s = await ntp.measure()
+    if s is None:
+        print("asy_ntp_time returns None")
+        return None
+    return (ntp._clock.ms() + s.offset) // 1000
 
 # There's currently no timezone support in MicroPython, and the RTC is set in UTC time.
 def settime(t):
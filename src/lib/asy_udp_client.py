@@ -1,59 +1,73 @@
 #
 # asy_udp_client.py
 #
+# Datagrams over a connected UDP socket. The socket is handed to the uasyncio
+# poller as a stream, so waiting for a reply costs no CPU, and every wait has
+# a deadline.
+#
+#   cli = AsyUDPClient(addr)
+#   reply = await cli.send_and_receive(query, tries=3)
+#   await cli.disconnect()
+#
 import time
 import uasyncio as asyncio
-import select
 import socket
 
+RX_SIZE = 512   # largest datagram expected, enough for NTP and DNS
+
 class AsyUDPClient:
     def __init__(self, addr, rx_timeout_ms = 1000, tx_timeout_ms = 200):
         self.addr = addr
         self.sock = None
-        self.poller = None
-        self.rx_timeout_us = rx_timeout_ms * 1000
-        self.tx_timeout_us = tx_timeout_ms * 1000
+        self.stream = None
+        self.rx_timeout_ms = rx_timeout_ms
+        self.tx_timeout_ms = tx_timeout_ms
 
-    async def _connect(self):
+    def _connect(self):
         if self.sock is None:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.sock.connect(self.addr)
-            self.sock.settimeout(0)
-            self.poller = select.poll()
-            self.poller.register(self.sock, select.POLLIN | select.POLLOUT)
-
-    async def ready(self, mask, timeout_ms = None):
-        await self._connect()
-        t0 = time.ticks_us()
-        while True:
-            if (p := self.poller.poll(0)):
-                if (p[0][1] & mask):
-#                    print("ready: ",time.ticks_diff(time.ticks_us(), t0), " us")
-                    return True
-            else:
-                if timeout_ms > 0 and time.ticks_diff(time.ticks_us(), t0) > timeout_us:
-                    return False
-            await asyncio.sleep(0)
+            self.sock.setblocking(False)
+            self.stream = asyncio.StreamReader(self.sock)
 
+    # send one datagram, returns False if the socket stayed busy for tx_timeout_ms
     async def send(self, msg):
-        if await self.ready(select.POLLOUT):
-            return self.sock.write(msg)
-        return None
+        self._connect()
+        try:
+            self.stream.write(msg)
+            await asyncio.wait_for_ms(self.stream.drain(), self.tx_timeout_ms)
+            return True
+        except asyncio.TimeoutError:
+            return False
 
-    async def receive(self, n=None, timeout_ms=-1):
-        if await self.ready(select.POLLIN, timeout_ms=timeout_ms):
-            return self.sock.read()
-        return None
+    # next datagram, None if nothing arrives within timeout_ms (rx_timeout_ms by default)
+    async def receive(self, n=RX_SIZE, timeout_ms=None):
+        self._connect()
+        try:
+            return await asyncio.wait_for_ms(self.stream.read(n),
+                                             self.rx_timeout_ms if timeout_ms is None else timeout_ms)
+        except asyncio.TimeoutError:
+            return None
 
-    async def send_and_receive(self, msg, tries=1):
+    # send msg and wait for the reply, up to tries times. match(reply) can reject
+    # datagrams that are not the answer, e.g. late replies to an earlier try.
+    async def send_and_receive(self, msg, tries=1, match=None):
         for _ in range(tries):
-            await self.send(msg)
-            return await self.receive()
+            if not await self.send(msg):
+                continue
+            deadline = time.ticks_add(time.ticks_ms(), self.rx_timeout_ms)
+            while (left := time.ticks_diff(deadline, time.ticks_ms())) > 0:
+                reply = await self.receive(timeout_ms=left)
+                if reply is None:
+                    break
+                if match is None or match(reply):
+                    return reply
         return None
 
     async def disconnect(self):
-        if not (self.sock is None):
-            self.poller.unregister(self.sock)
-            self.sock.close()
-            self.sock = undef
+        if self.sock is not None:
+            self.stream.close()
+            await self.stream.wait_closed()
+            self.sock = None
+            self.stream = None
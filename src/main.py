@@ -4,25 +4,38 @@ import machine
 from utime import sleep
 import _thread
 import pt6315
-import time, asyncio, ntptime, random
+import time, asyncio, random
 import futaba_8md06inkm
 import futaba_8md06inkm_term
 import boratcast_vfd
-from asy_ntp_time import asy_ntp_time, settime
+import spibus
+from asy_ntp_time import NTPClient
 
 import util
-from primitives import Queue
+import clock as clock_renderer
+import report
 import wttrin
+import asy_http_client
 import uping
 
 SPICLK=1000000
-TIME_SYNC_INTERVAL=3600*8
+SPICLK_FUTABA=5000000
+TIME_SYNC_TARGET_MS=250	# resync before the clock is off by more than this
 RECONNECT_INTERVAL=2
 VFD_NCHARS=6
 SCROLL_PACE = 0.1
+DISPLAY_INTERVAL_MS = 20	# display refresh at most 50 times a second
 PERIOD_WEATHER=60	# display weather once a minute +-
 PERIOD_WEATHER_REQUEST=20 	# request fresh weather every 20 mins
+WEATHER_CACHE_CLOCK_WAIT=30	# seconds to wait for the clock before fetching weather
+WEATHER_STALE_AGE=3600		# older weather is reported as CACHED
+WEATHER_MAX_AGE=6*3600		# older weather is not reported at all
+PERIOD_FORECAST_REQUEST=180	# request the forecast every 3 hours
+FORECAST_SLOTS=4			# forecast for 4 3-hour slots, 12 hours ahead
 PERIOD_PING=60*5	# ping hosts every 5 min
+REPORT_QUEUE_SIZE=4
+PRIORITY_WEATHER=0
+PRIORITY_STATUS=1
 
 BRIGHTNESS_DAY=2
 BRIGHTNESS_NIGHT=1
@@ -38,16 +51,21 @@ def set_status(rgb):
     status_led.write()
 
 hspi = SPI(1, baudrate=SPICLK, firstbit=SPI.LSB, sck=Pin(6), mosi=Pin(7), miso=Pin(8))
+bus = spibus.SPIBus(hspi)
+vfd1_spi = bus.device('pt6315', baudrate=SPICLK, polarity=0, phase=0, firstbit=SPI.LSB)
+vfd2_spi = bus.device('futaba', baudrate=SPICLK_FUTABA, polarity=0, phase=0, firstbit=SPI.LSB)
+
 vfd1_cs = Pin(9, mode=Pin.OUT, value=1)
-vfd1_drv = pt6315.PT6315(hspi, pin_cs=vfd1_cs)
+vfd1_drv = pt6315.PT6315(vfd1_spi, pin_cs=vfd1_cs)
 term1 = pt6315.Term(vfd1_drv)
 
 vfd2_cs = Pin(4, mode=Pin.OUT, value=1)
 vfd2_res = Pin(5, mode=Pin.OUT, value=1)
-vfd2_drv = futaba_8md06inkm.VFD(hspi, vfd2_res, vfd2_cs, None, digits=8, dimming=255)
+vfd2_drv = futaba_8md06inkm.VFD(vfd2_spi, vfd2_res, vfd2_cs, None, digits=8, dimming=255)
 term2 = futaba_8md06inkm_term.Term(vfd2_drv)
 
 vfd = boratcast_vfd.Boratcast([term1, term2])
+display_writer = boratcast_vfd.DisplayWriter(vfd, DISPLAY_INTERVAL_MS, bus)
 
 sleep(0.25)
 
@@ -71,6 +89,8 @@ VFD_WTF_PLAY2 = 0x90    # small right triangle
 VFD_WTF_STOP = 0x1fe	# just box
 VFD_WTF_PERSP = 0x103	# kind of runway in perspective
 
+REPORT_ICONS = {'A': VFD_WTF_PLAY, 'B': VFD_WTF_EJECT, 'C': VFD_WTF_STOP}
+
 def vfd_rec_status(on):
     if on:
         vfd_status[1] |= VFD_STATUS_REC
@@ -122,23 +142,29 @@ class VFDStatus:
 
 wifi.connect_threaded()
 
-report_queue = Queue()		# messages
+report_queue = report.ReportQueue(REPORT_QUEUE_SIZE)		# messages
 
 weatherman = wttrin.Weatherman()
 
+clock = clock_renderer.ClockRenderer()
+ntp = NTPClient(target_error_ms=TIME_SYNC_TARGET_MS)
+
 async def at_timesync():
     while True:
         if wifi.isconnected():
             util.TZ_OFFSET=wifi.timezone * 3600
             
             print('ntptime...', end='')
-            ntp_time = await asy_ntp_time()
-            settime(ntp_time)
-            print('(async) ntp_time is ', ntp_time)
-            global time_is_set
-            time_is_set = True
-            print("synced time: ", util.localtime(time.time()))
-            await asyncio.sleep(TIME_SYNC_INTERVAL)
+            sample = await ntp.sync()
+            if sample is not None:
+                clock.sync()
+                print('(async) ntp', sample)
+                global time_is_set
+                time_is_set = True
+                print("synced time: ", util.localtime(time.time()), 'drift ppm:', ntp.drift_ppm, 'next in', ntp.interval)
+            else:
+                print('failed')
+            await asyncio.sleep(ntp.interval)
         else:
             await asyncio.sleep(RECONNECT_INTERVAL)
         
@@ -160,54 +186,30 @@ async def at_blinker():
         await asyncio.sleep(0.25)
         
 async def at_printtask():
-    lastsep = '-'
-    state = 0
+    brightness = -1
     while True:
         if report_queue.empty():
-            dtime = util.localtime(time.time()) # year, month, mday, hour, minute, second, weekday, yearday
-            sep = ':' if (time.time_ns() % 1000000000) // 100000000 < 5 else ' '
-            if sep != lastsep:
-                if time_is_set:
-                    timestr = '\014%02d%c%02d' % (dtime[3],sep,dtime[4])
-                else:
-                    timestr = f'\014--{sep}--'
-                vfd.puts(timestr)
-                
-                vfd.setBrightness(BRIGHTNESS_NIGHT if dtime[3] < 9 else BRIGHTNESS_DAY)
-            await asyncio.sleep(0.05)
-        else:
-            report = await report_queue.get()
-            pace = 0
-            for c in report:
-                if state == 1:
-                    if c == 'A':
-                        vfd_wtf(VFD_WTF_PLAY)
-                    elif c == 'B':
-                        vfd_wtf(VFD_WTF_EJECT)
-                    elif c == 'C':
-                        vfd_wtf(VFD_WTF_STOP)
-                    else:
-                        vfd_wtf(0)
-                    state = 0
-                else:
-                    if c == '~':
-                        vfd.flush()
-                        await asyncio.sleep(1)
-                    elif c == '#':
-                        vfd.flush()
-                        await asyncio.sleep(0.1)
-                    elif c == '\001':
-                        pace = SCROLL_PACE if pace == 0 else 0
-                    elif c == '\002':
-                        state = 1
-                    else:
-                        vfd.putchar(c)
-                        if pace > 0 or ord(c) < 32:
-                            vfd.flush()
-                        if pace > 0:
-                            await asyncio.sleep(pace)
-            vfd.flush()
+            wait_ms = clock.draw(vfd, time_is_set)
+            b = BRIGHTNESS_NIGHT if clock.hour() < 9 else BRIGHTNESS_DAY
+            if b != brightness:
+                brightness = b
+                vfd.setBrightness(b)
+            # sleep until the clock face changes, a report waits for that at most;
+            # sleep_ms() with an int allocates nothing, unlike wait_for()
+            await asyncio.sleep_ms(wait_ms)
+            continue
+        job = await report_queue.get()
+        try:
+            await report.play(job.report, vfd, vfd_wtf)
+        except BaseException:
+            job.finish(False)
+            raise
+        job.finish(True)
+        clock.invalidate()
         
+def compile_report(s):
+    return report.compile(s, REPORT_ICONS, int(SCROLL_PACE * 1000))
+
 def blink(s, n):
     ret = ''
     for i in range(n):
@@ -221,49 +223,124 @@ def nblink(n, width, times):
     ret += f'{n:{width}}'
     return ret
 
+# wifi.city may list several locations separated by ';', e.g. 'Paris;Oslo'
+def cities():
+    return [c.strip() for c in wifi.city.split(';') if c.strip()]
+
+def weather_report(w, forecast=None, stale=False):
+    reports = []
+    reports.append(blink(f"{w.location:{VFD_NCHARS}}", 4))
+    reports.append(f"\r{w.location:{VFD_NCHARS}}~")
+    if stale:
+        reports.append(f"\r{'CACHED':{VFD_NCHARS}}~")
+    reports.append("\002A") # icon "PLAY" on
+    reports.append(f"\001  {w.condition:{VFD_NCHARS}}\001~~")
+    temp = f'{w.feelslike:+d}\xb0C'
+    reports.append(f"\001  {temp:{VFD_NCHARS}}\001~~~~")
+    reports.append(f"\001  {'WIND':{VFD_NCHARS}}\001####\001{w.wind_text()}\001~~")
+    
+    if w.precipitation > 0:
+        reports.append(f"\001  {'RAIN':{VFD_NCHARS}}\001####\001{w.precipitation_text():{VFD_NCHARS}}\001~~")
+    humidity = f'{w.humidity}%'
+    reports.append(f"\001  HUM{humidity:{VFD_NCHARS-3}}\001~~")
+    
+    uv = w.uv
+    if uv > 1:
+        if uv < 6:
+            reports.append(f"\001  UVI{uv:>3}\001~")
+        else:
+            reports.append(f"\001  UVI{uv:>3}\001")
+            reports.append(f"\rUVI {nblink(uv, 2, 4)}~")
+    reports.append("\002a") # icon "PLAY" off
+    reports.append("\014####")
+    fc = forecast
+    if fc != None:
+        temps = [fc.temperature(i) for i in range(fc.nslots)]
+        rain = max(fc.chance_of_rain(i) for i in range(fc.nslots))
+        reports.append(f"\001  NEXT {fc.nslots*3}H {min(temps)}..{max(temps)}\xb0C RAIN {rain}%\001~~")
+    moon = w.moon_phase_text()
+    if moon != None:
+        reports.append(f"\002C\001{moon}~~\001\002c\014####") # icon STOP
+    return reports
+
 async def at_weather_reporter():
     await asyncio.sleep(random.randint(5,15))
+    compiled = {}   # location -> (reports, timeline)
+    turn = 0
     while True:
-        if weatherman.get('condition') != None:
-            await report_queue.put(blink(f"{wifi.city:{VFD_NCHARS}}", 4))
-            await report_queue.put(f"\r{wifi.city:{VFD_NCHARS}}~")
-            await report_queue.put("\002A") # icon "PLAY" on
-            await report_queue.put(f"\001  {weatherman.get('condition'):{VFD_NCHARS}}\001~~")
-            temp = weatherman.get('feelslike') # .replace('\xb0','"')
-            await report_queue.put(f"\001  {temp:{VFD_NCHARS}}\001~~~~")
-            await report_queue.put(f"\001  {'WIND':{VFD_NCHARS}}\001####\001{weatherman.get('wind')}\001~~")
-            
-            rain = weatherman.get('precipitation')            
-            if rain != '0.0mm':
-                await report_queue.put(f"\001  {'RAIN':{VFD_NCHARS}}\001####\001{rain:{VFD_NCHARS}}\001~~")
-            await report_queue.put(f"\001  HUM{weatherman.get('humidity'):{VFD_NCHARS-3}}\001~~")
-            
-            uv = weatherman.get('uv')            
-            if int(uv) > 1:
-                if int(uv) < 6:
-                    await report_queue.put(f"\001  UVI{uv:>3}\001~")
-                else:
-                    await report_queue.put(f"\001  UVI{uv:>3}\001")
-                    await report_queue.put(f"\rUVI {nblink(uv, 2, 4)}~")
-            await report_queue.put("\002a") # icon "PLAY" off
-            await report_queue.put("\014####")
-            moon = weatherman.get_moon_phase_text()
-            if moon != None:
-                await report_queue.put(f"\002C\001{moon}~~\001\002c\014####") # icon STOP
+        locations = cities()
+        # without the clock the age is unknown, cached weather is shown as stale
+        now = time.time() if time_is_set else None
+        # rotate through the locations, one per report, skipping weather known to be too old
+        for i in range(len(locations)):
+            location = locations[(turn + i) % len(locations)]
+            w = weatherman.weather(location)
+            age = None if w == None or now is None else w.age(now)
+            if w != None and (age is None or age <= WEATHER_MAX_AGE):
+                turn = (turn + i + 1) % len(locations)
+                break
+        else:
+            w = None
+        if w != None:
+            stale = now is None or w.is_stale(WEATHER_STALE_AGE, now)
+            # the forecast is fetched for the first location only
+            r = weather_report(w, weatherman.forecast if w.location == locations[0] else None, stale)
+            # compile only when the report text changes, normally once per weather request
+            reports, timeline = compiled.get(w.location, (None, None))
+            if r != reports:
+                timeline = [step for s in r for step in compile_report(s)]
+                compiled[w.location] = (r, timeline)
+            job = report_queue.put(timeline, PRIORITY_WEATHER, key='weather')
+            await job.wait()
                     
         await asyncio.sleep(PERIOD_WEATHER + random.randint(-10,10))
         
 async def at_weather_requester():
+    waited = 0
+    forecast_due = 0
     while True:
         if wifi.isconnected():
+            # weather needs the clock to tell how old it is, both the cached one
+            # from flash and the one about to be fetched
+            if not time_is_set and waited < WEATHER_CACHE_CLOCK_WAIT:
+                waited += 1
+                await asyncio.sleep(1)
+                continue
+            locations = cities()
+            cached = [weatherman.weather(l) for l in locations]
+            if locations and None not in cached:
+                # all locations are fetched together, the oldest one decides;
+                # weather fetched before the clock was set has no age and is stale
+                now = time.time()
+                if time_is_set and not any(w.is_stale(60*PERIOD_WEATHER_REQUEST, now) for w in cached):
+                    age = max(w.age(now) for w in cached)
+                    await asyncio.sleep(60*PERIOD_WEATHER_REQUEST - age)
             print('wttr...', end='')
+            now = time.time() if time_is_set else None
             with VFDStatus(VFD_STATUS_CLOCK):
-                res = weatherman.request(wifi.city)
-            print('done')    
+                res = await weatherman.request(locations, now)
+            print('done', asy_http_client.pool.last)
             if res:
+                forecast_due -= 1
+                if forecast_due <= 0:
+                    print('wttr forecast...', end='')
+                    with VFDStatus(VFD_STATUS_CLOCK):
+                        if await weatherman.request_forecast(locations[0], FORECAST_SLOTS, clock.hour() // 3):
+                            forecast_due = PERIOD_FORECAST_REQUEST // PERIOD_WEATHER_REQUEST
+                    print('done', asy_http_client.pool.last)
+            # the batch is over, free the TLS connection until the next one
+            await asy_http_client.pool.close()
+            if not res:
+                await asyncio.sleep(60)		# some error, retry in 1 min
+            elif now is not None:
                 await asyncio.sleep(60*PERIOD_WEATHER_REQUEST)	# all good, wait 30 min
             else:
-                await asyncio.sleep(60)		# some error, retry in 1 min
+                # fetched without the clock, so it shows as cached; fetch again
+                # as soon as the clock is set
+                for _ in range(60*PERIOD_WEATHER_REQUEST):
+                    if time_is_set:
+                        break
+                    await asyncio.sleep(1)
         else:
             await asyncio.sleep(1)
             
@@ -271,8 +348,9 @@ async def at_wifi_reporter():
     while True:
         if not wifi.isconnected():
             if wifi.message != None and wifi.message != '':                
-                await report_queue.put(f"\001{wifi.message}...\001")
-                await asyncio.sleep(len(wifi.message)*0.2 + 2)
+                job = report_queue.put(compile_report(f"\001{wifi.message}...\001"), PRIORITY_STATUS, key='wifi')
+                await job.wait()
+                await asyncio.sleep(2)
             else:
                 await asyncio.sleep(0.2)
         else:
@@ -280,25 +358,32 @@ async def at_wifi_reporter():
    
 boot_btn_pressed = False   
    
+def button_pressed(bootbtn):
+    # pin 9 is both PT6315 CS and BOOT button, keep the bus away while it's an input
+    with bus:
+        bootbtn.init(mode=Pin.IN, pull=Pin.PULL_UP)
+        pressed = bootbtn.value() == 0
+        bootbtn.init(mode=Pin.OUT, pull=None, value=1)   # restore pin 9 = CS
+    return pressed
+   
 async def at_button_check():
     bootbtn = vfd1_cs#Pin(9, Pin.IN, Pin.PULL_UP)
     while True:
-        bootbtn.init(mode=Pin.IN, pull=Pin.PULL_UP)
-        if bootbtn.value() == 0:
+        if button_pressed(bootbtn):
             print("BOOT btn pressed")            
-            while bootbtn.value() == 0:
+            while button_pressed(bootbtn):
                 await asyncio.sleep(0.25)
-            bootbtn.init(mode=Pin.OUT, pull=None, value=1)   # restore pin 9 = CS
             print("BOOT btn released")
             global boot_btn_pressed
             boot_btn_pressed = True
             #raise Exception("BOOT btn pressed")
             break
-        bootbtn.init(mode=Pin.OUT, pull=None, value=1)    # restore pin 9 = CS
         await asyncio.sleep(1)
         
             
 async def at_main(duration):
+    vfd.attach(display_writer)
+    asyncio.create_task(display_writer.run())
     asyncio.create_task(at_blinker())
     asyncio.create_task(at_printtask())
     asyncio.create_task(at_wifi_reporter())
@@ -323,6 +408,7 @@ def async_run(duration=120):
         print("Interrupted")
     finally:
         asyncio.new_event_loop()
+        vfd.attach(None)    # no writer task anymore, write in place
         print("async_run done")
 
 async_run(-1)
@@ -74,52 +74,11 @@ VFD_NCHARS = 6
 
 import font
 
-def clamp(x, l, u):
-    return l if x < l else u if x > u else x
-
-
+# Output of a boratcast_vfd.Boratcast, which interprets the text and control
+# codes once for all terminals and hands over the frame to render()
 class Term:
     def __init__(self, drv):
         self._drv = drv
-        
-    def cls(self, flush=True, nchars=PT6315_DISPLAY_MEM_SZ):
-        self._drv.cls(flush=flush, nchars=nchars)
-
-    def flush(self):
-        self._drv.flush()
-
-    def home(self):
-        self._drv.setpos(0)
-
-    def pos(self) -> int:
-        return self._drv.pos()
-    
-    # write glyph (3 bytes) directly at position pos
-    def direct(self, pos, glyph):
-        self._drv.direct(pos, glyph)
-
-    def putchar(self, c):
-        if c == '\n' or c == '\r':
-            self.home()
-            return
-        elif c == '\014':   # ^L form feed
-            self._drv.cls()
-            return
-        elif c == '\010': # ^H backspace
-            self._drv.setpos(self.pos() - 1)
-            return
-        
-        # auto scroll
-        self._drv.autoscroll()
-
-        glyph = font.vfd_get_glyph(c)
-        self._drv.putglyph(glyph)
-
-    def puts(self, s, flush=True):
-        for c in s:
-            self.putchar(c)
-        if flush:
-            self.flush()
 
     def begin(self):
         self._drv.begin()
@@ -133,6 +92,16 @@ class Term:
     def setDisplay(self, on):
         self._drv.setDisplay(on)
 
+    def width(self) -> int:
+        return self._drv.width()
+
+    # show frame.cells[origin:origin+width] and the frame icons (see boratcast_vfd.Frame)
+    def render(self, frame, origin):
+        self._drv.putcells(frame.cells, origin, self._drv.width())
+        if frame.icons_pos >= 0:
+            self._drv.setgrid(frame.icons_pos, frame.icons)
+        self._drv.flush()
+
 
 class PT6315:
     pin_cs = -1
@@ -141,20 +110,28 @@ class PT6315:
     _display = PT6315_DSP_OFF
     _bright = PT6315_BRT0
     _leftpadding = PT6315_VFD_LEFTPADDING 
-    _displaymem = bytearray(PT6315_DISPLAY_MEM_SZ)
-    _lastaddr = 0
-    _cursoraddr = 0
+    _nchars = VFD_NCHARS
 
     def spiwrbyte(self, byte):
-        self.spi.write(byte.to_bytes(1, 'little'))
+        self._cmdbuf[0] = byte
+        self.spi.write(self._cmdbuf)
     
-    def __init__(self, spi, pin_cs, mode=PT6315_GR7_SEG21):
+    # spi is a spibus.SPIDevice, pin_cs the chip select of this panel
+    def __init__(self, spi, pin_cs, mode=PT6315_GR7_SEG21, nchars=VFD_NCHARS):
         self.spi = spi
         self.pin_cs = pin_cs
         self._mode = mode
+        self._nchars = nchars
+        self._displaymem = bytearray(PT6315_DISPLAY_MEM_SZ)
         self.pin_cs.on()
-        self._cursoraddr = 0
-        self._lastaddr = 0
+        self._cmdbuf = bytearray(1)
+        # address command + whole display memory, sent as one auto-increment burst
+        self._txbuf = bytearray(1 + PT6315_DISPLAY_MEM_SZ)
+        # preallocated views of _txbuf for every transfer length, so flush doesn't allocate
+        self._txviews = [memoryview(self._txbuf)[0:n] for n in range(len(self._txbuf) + 1)]
+        # what the controller RAM holds after the last flush
+        self._shadow = bytearray(PT6315_DISPLAY_MEM_SZ)
+        self.invalidate()
 
     def begin(self):
         self._writeCmd(PT6315_MODE_SET_CMD, self._mode)
@@ -171,58 +148,151 @@ class PT6315:
         self._writeCmd(PT6315_DSP_CTRL_CMD, self._display | self._bright )
 
     def _writeCmd(self, cmd, data):
-        self.pin_cs(0)
-        try:
-            self.spiwrbyte((cmd & PT6315_CMD_MSK) | (data & ~PT6315_CMD_MSK))
-        finally:
-            self.pin_cs(1)
+        with self.spi:
+            self.pin_cs(0)
+            try:
+                self.spiwrbyte((cmd & PT6315_CMD_MSK) | (data & ~PT6315_CMD_MSK))
+            finally:
+                self.pin_cs(1)
+
+    # mark display memory [lo, hi) as changed since the last flush
+    def _touch(self, lo, hi):
+        if lo < self._dirty_lo:
+            self._dirty_lo = lo
+        if hi > self._dirty_hi:
+            self._dirty_hi = hi
+
+    # forget what the controller holds, next flush sends the whole text area
+    def invalidate(self):
+        self._synced = False
+        self._dirty_lo = 0
+        self._dirty_hi = self._nchars * 3
+
+    def _send(self, n):
+        with self.spi:
+            self.pin_cs(0)
+            try:
+                self.spi.write(self._txviews[n])
+            finally:
+                self.pin_cs(1)
 
     def direct(self, pos, glyph):
         # write glyph (3 bytes) directly at position pos
-        self.pin_cs(0)
-        try:
-            self.spiwrbyte(PT6315_ADDR_SET_CMD | (pos * 3))
-            for d in glyph:
-                self.spiwrbyte(d)
-        finally:
-            self.pin_cs(1)
+        tx = self._txbuf
+        a = pos * 3
+        tx[0] = PT6315_ADDR_SET_CMD | a
+        for i in range(3):
+            tx[i + 1] = self._displaymem[a + i] = self._shadow[a + i] = glyph[i]
+        self._send(4)
+
+    # put glyph (3 bytes) at grid pos, sent by the next flush
+    def setgrid(self, pos, glyph):
+        a = pos * 3
+        mem = self._displaymem
+        for i in range(3):
+            mem[a + i] = glyph[i]
+        self._touch(a, a + 3)
+
+    # fill n grids from position 0 with the glyphs of character codes cells[start:start+n]
+    def putcells(self, cells, start, n):
+        mem = self._displaymem
+        g = font.GLYPHS
+        a = self._leftpadding * 3
+        for i in range(start, start + n):
+            o = cells[i] * 3
+            mem[a] = g[o]
+            mem[a + 1] = g[o + 1]
+            mem[a + 2] = g[o + 2]
+            a += 3
+        self._touch(self._leftpadding * 3, a)
+
+    def width(self):
+        return self._nchars
+
+    # move the changed bytes to the transmit buffer, returns the transfer length or 0
+    def _prepare(self):
+        lo = self._dirty_lo
+        hi = self._dirty_hi
+        if lo >= hi:
+            return 0
+        mem = self._displaymem
+        shadow = self._shadow
+        if self._synced:
+            # trim the bytes that the controller already has
+            while lo < hi and mem[lo] == shadow[lo]:
+                lo += 1
+            while hi > lo and mem[hi - 1] == shadow[hi - 1]:
+                hi -= 1
+        self._dirty_lo = PT6315_DISPLAY_MEM_SZ
+        self._dirty_hi = 0
+        self._synced = True
+        if lo >= hi:
+            return 0
+
+        tx = self._txbuf
+        tx[0] = PT6315_ADDR_SET_CMD | lo
+        for i in range(lo, hi):
+            tx[i - lo + 1] = shadow[i] = mem[i]
+        return hi - lo + 1
 
     def flush(self):
-        self.pin_cs(0)
-        try:
-            self.spiwrbyte(PT6315_ADDR_SET_CMD | 0x00) # addr = 0
-
-            for d in self._displaymem[0:VFD_NCHARS*3]:
-                self.spiwrbyte(d)
-        finally:
-            self.pin_cs(1)
+        n = self._prepare()
+        if n:
+            self._send(n)
 
     def cls(self, flush=False, nchars=PT6315_DISPLAY_MEM_SZ):
-        self._displaymem[0:VFD_NCHARS * 3] = bytearray([0] * (VFD_NCHARS * 3))
-        self.setpos(0)
+        mem = self._displaymem
+        for i in range(self._nchars * 3):
+            mem[i] = 0
+        self._touch(0, self._nchars * 3)
         if flush:
             self.flush()
 
-    def putglyph(self, glyph):
-        self._lastaddr = self._cursoraddr
-        self._displaymem[self._cursoraddr] = (glyph >> 16) & 255
-        self._cursoraddr += 1
-        self._displaymem[self._cursoraddr] = (glyph >> 8) & 255
-        self._cursoraddr += 1
-        self._displaymem[self._cursoraddr] = glyph & 255
-        self._cursoraddr += 1
-
-    def autoscroll(self):
-        if self._cursoraddr >= VFD_NCHARS * 3:
-            self._displaymem[0:(VFD_NCHARS-1) * 3] = self._displaymem[3:VFD_NCHARS * 3]
-            self._cursoraddr -= 3
-
-    def setpos(self, pos):
-        self._cursoraddr = self._leftpadding * 3 + pos * 3
-        self._cursoraddr = clamp(self._cursoraddr, 0, len(self._displaymem) - 1)
-        self._lastaddr = self._cursoraddr
-        
-    def pos(self):
-        return self._cursoraddr // 3
-        
 
+
+# Several PT6315 panels on the same bus, each with its own CS pin.
+# flush() prepares every panel first and then sends the transfers back to back
+# in one bus acquisition, so the panels of a wall of clocks change together.
+class PT6315Group:
+    def __init__(self, panels):
+        self._panels = panels
+        self._pending = [0] * len(panels)
+
+    def panels(self):
+        return self._panels
+
+    def begin(self):
+        for p in self._panels:
+            p.begin()
+
+    def end(self):
+        for p in self._panels:
+            p.end()
+
+    def setBrightness(self, brightness=PT6315_BRT_DEF):
+        for p in self._panels:
+            p.setBrightness(brightness)
+
+    def setDisplay(self, on):
+        for p in self._panels:
+            p.setDisplay(on)
+
+    def cls(self, flush=False):
+        for p in self._panels:
+            p.cls(flush=False)
+        if flush:
+            self.flush()
+
+    def flush(self):
+        panels = self._panels
+        pending = self._pending
+        n = 0
+        for i in range(len(panels)):
+            pending[i] = panels[i]._prepare()
+            n += pending[i]
+        if n == 0:
+            return
+        with panels[0].spi.bus:
+            for i in range(len(panels)):
+                if pending[i]:
+                    panels[i]._send(pending[i])
@@ -0,0 +1,186 @@
+# report
+#
+# Reports are strings in a small display language:
+#   ~               show, hold for 1 s
+#   #               show, hold for 0.1 s
+#   \001            scrolling on/off: show every character and hold it for the pace
+#   \002X           icon X from the icons table, any other character clears the icon
+#   \r \n \010 \014 terminal control codes, everything else is printed
+#
+# compile() interprets a report once into a timeline, a list of steps
+#   (text, icon, hold_ms)
+# text is printed, then icon is set (None leaves it as it is), the frame is shown
+# and held for hold_ms. Steps that are not held are merged into the next one,
+# holds without changes in between are added up.
+# play() replays a timeline.
+#
+# ReportQueue holds the timelines waiting to be played, every queued report has
+# a ReportJob that tells when it was played or dropped.
+import asyncio
+import time
+
+HOLD_LONG_MS = 1000
+HOLD_SHORT_MS = 100
+PACE_MS = 100
+
+
+def compile(report, icons={}, pace_ms=PACE_MS):
+    timeline = []
+    text = []
+    icon = None
+    pace = 0
+    escape = False
+    for c in report:
+        hold = -1
+        if escape:
+            icon = icons.get(c, 0)
+            escape = False
+        elif c == '~':
+            hold = HOLD_LONG_MS
+        elif c == '#':
+            hold = HOLD_SHORT_MS
+        elif c == '\001':
+            pace = pace_ms if pace == 0 else 0
+        elif c == '\002':
+            escape = True
+        else:
+            text.append(c)
+            if pace > 0:
+                hold = pace
+        if hold > 0:
+            if not text and icon is None and timeline:
+                # nothing changed, hold the previous step longer
+                t, i, h = timeline[-1]
+                timeline[-1] = (t, i, h + hold)
+            else:
+                timeline.append((''.join(text), icon, hold))
+            text = []
+            icon = None
+    if text or icon is not None or not timeline:
+        timeline.append((''.join(text), icon, 0))
+    return timeline
+
+
+# vfd is a Boratcast, set_icon(icon) shows an icon
+async def play(timeline, vfd, set_icon):
+    for text, icon, hold_ms in timeline:
+        vfd.puts(text, flush=False)
+        if icon is not None:
+            set_icon(icon)
+        vfd.flush()
+        if hold_ms:
+            await asyncio.sleep(hold_ms / 1000)
+
+
+# Handle of a queued report
+#   played = await job.wait()
+class ReportJob:
+    def __init__(self, report):
+        self.report = report
+        self.played = None      # True when played, False when dropped, None while queued
+        self._done = asyncio.Event()
+
+    def done(self):
+        return self.played is not None
+
+    def finish(self, played):
+        self.played = played
+        self._done.set()
+
+    # wait until the report was played (returns True) or dropped (False)
+    async def wait(self):
+        await self._done.wait()
+        return self.played
+
+
+# Bounded queue of reports. Higher priority reports are played first, reports
+# of the same priority in order. A report put with a key replaces the unplayed
+# report with the same key, so a fresh weather report takes the place of a stale
+# one. When the queue is full the oldest report of the lowest priority is dropped
+# (or the new one, if its priority is lower still).
+class ReportQueue:
+    def __init__(self, maxsize=4):
+        self._maxsize = maxsize
+        self._entries = []      # [priority, sequence, key, job, ticks_ms when put]
+        self._seq = 0
+        self._nonempty = asyncio.Event()
+        self.puts = 0
+        self.gets = 0
+        self.drops = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.wait_ms_total = 0
+        self.wait_ms_max = 0
+
+    def empty(self):
+        return not self._entries
+
+    def qsize(self):
+        return len(self._entries)
+
+    # entry that gets dropped first
+    def _victim(self):
+        victim = None
+        for e in self._entries:
+            if victim is None or e[0] < victim[0] or (e[0] == victim[0] and e[1] < victim[1]):
+                victim = e
+        return victim
+
+    # queue report without waiting, returns its ReportJob
+    def put(self, report, priority=0, key=None):
+        self.puts += 1
+        job = ReportJob(report)
+        entries = self._entries
+        if key is not None:
+            for e in entries:
+                if e[2] == key:
+                    e[3].finish(False)
+                    e[0] = priority
+                    e[3] = job
+                    self.coalesced += 1
+                    return job
+
+        if len(entries) >= self._maxsize:
+            victim = self._victim()
+            self.drops += 1
+            if victim[0] > priority:
+                job.finish(False)
+                return job
+            entries.remove(victim)
+            victim[3].finish(False)
+
+        self._seq += 1
+        entries.append([priority, self._seq, key, job, time.ticks_ms()])
+        if len(entries) > self.max_depth:
+            self.max_depth = len(entries)
+        self._nonempty.set()
+        return job
+
+    # next ReportJob to play, the player calls job.finish(True) when done
+    async def get(self):
+        while not self._entries:
+            self._nonempty.clear()
+            await self._nonempty.wait()
+        best = None
+        for e in self._entries:
+            if best is None or e[0] > best[0] or (e[0] == best[0] and e[1] < best[1]):
+                best = e
+        self._entries.remove(best)
+
+        wait_ms = time.ticks_diff(time.ticks_ms(), best[4])
+        self.gets += 1
+        self.wait_ms_total += wait_ms
+        if wait_ms > self.wait_ms_max:
+            self.wait_ms_max = wait_ms
+        return best[3]
+
+    def stats(self):
+        return {
+            'depth': len(self._entries),
+            'max_depth': self.max_depth,
+            'puts': self.puts,
+            'drops': self.drops,
+            'coalesced': self.coalesced,
+            'wait_ms_avg': self.wait_ms_total // self.gets if self.gets else 0,
+            'wait_ms_max': self.wait_ms_max,
+        }
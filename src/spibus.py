@@ -0,0 +1,146 @@
+# spibus
+#
+# One SPI bus shared by several devices with different settings.
+#
+#   bus = SPIBus(SPI(1, sck=Pin(6), mosi=Pin(7), miso=Pin(8)))
+#   dev = bus.device('pt6315', baudrate=1000000, polarity=0, phase=0, firstbit=SPI.LSB)
+#   with dev:
+#       cs(0)
+#       dev.write(buf)
+#       cs(1)
+#
+# The bus remembers which settings it runs with and calls spi.init() only when
+# a device with different settings writes. Access is serialized by one lock
+# shared by coroutines and _thread workers.
+#
+# 'with dev:' is for synchronous sections: it blocks until the lock is free and
+# is reentrant per thread, all coroutines being one thread it must not be held
+# across an await. Coroutines that may find the bus taken by a _thread worker,
+# or need to hold it across an await, use 'async with dev:' instead. It waits
+# by yielding to the event loop and holds the bus for the current task; a
+# synchronous section of another task that runs into it raises RuntimeError.
+import _thread
+import asyncio
+
+
+class SPIDevice:
+    def __init__(self, bus, name, config):
+        self.bus = bus
+        self.name = name
+        self.config = config
+        self._depth = 0
+        self.transactions = 0
+        self.nbytes = 0
+        self.reconfigs = 0
+
+    def __enter__(self):
+        self.bus.acquire()
+        if self._depth == 0:
+            self.transactions += 1
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._depth -= 1
+        self.bus.release()
+        return False
+
+    async def __aenter__(self):
+        await self.bus.acquire_async()
+        if self._depth == 0:
+            self.transactions += 1
+        self._depth += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+    def write(self, buf):
+        bus = self.bus
+        if bus._current is not self:
+            bus._select(self)
+        bus.spi.write(buf)
+        self.nbytes += len(buf)
+
+    def stats(self):
+        return (self.transactions, self.nbytes, self.reconfigs)
+
+
+class SPIBus:
+    def __init__(self, spi):
+        self.spi = spi
+        self._lock = _thread.allocate_lock()
+        self._owner = None
+        self._task = None       # task holding the bus with acquire_async()
+        self._depth = 0
+        self._current = None    # device whose settings the bus runs with
+        self._devices = []
+
+    def device(self, name, **config):
+        dev = SPIDevice(self, name, config)
+        self._devices.append(dev)
+        return dev
+
+    def acquire(self):
+        me = _thread.get_ident()
+        if self._owner != me:
+            self._lock.acquire()
+            self._owner = me
+        elif self._task is not None and self._task is not asyncio.current_task():
+            raise RuntimeError('SPI bus held by another task')
+        self._depth += 1
+
+    # acquire for the current task if the bus is free, returns False otherwise
+    def try_acquire(self):
+        me = _thread.get_ident()
+        task = asyncio.current_task()
+        if self._owner != me:
+            if not self._lock.acquire(0):
+                return False
+            self._owner = me
+        elif self._task is not None and self._task is not task:
+            return False
+        if self._task is None:
+            self._task = task
+        self._depth += 1
+        return True
+
+    # acquire without blocking the event loop, may be held across an await
+    async def acquire_async(self):
+        while not self.try_acquire():
+            await asyncio.sleep_ms(0)
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self._owner = None
+            self._task = None
+            self._lock.release()
+
+    # hold the bus without writing, e.g. while a CS pin is used for something else
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+    async def __aenter__(self):
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+    def _select(self, dev):
+        cur = self._current
+        if cur is None or cur.config != dev.config:
+            self.spi.init(**dev.config)
+            dev.reconfigs += 1
+        self._current = dev
+
+    # {name: (transactions, bytes, reconfigurations)}
+    def stats(self):
+        return {d.name: d.stats() for d in self._devices}
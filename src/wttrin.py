@@ -1,10 +1,13 @@
-import requests
-import _thread
 import gc
+from array import array
+import os
+import struct
+import time
 
 WTTR = 'https://wttr.in'
 NAMES = ['temperature', 'feelslike', 'condition', 'humidity', 'wind', 'precipitation', 'pressure', 'uv', 'moon']
 FORMAT = '%t:%f:%C:%h:%w:%p:%P:%u:%m'
+UNITS = 'm'     # metric: °C, km/h, mm, hPa
 MOON_PHASES = ("🌑", "🌒", "🌓", "🌔", "🌕", "🌖", "🌗", "🌘")
 MOON_PHASES_TEXT = (
      'NEW',
@@ -18,54 +21,504 @@ MOON_PHASES_TEXT = (
     
 WIND_DIRECTION = ("↓", "↙", "←", "↖", "↑", "↗", "→", "↘")
 
+CONNECT_TIMEOUT_MS = 10000
+READ_TIMEOUT_MS = 10000
+FORECAST_GZIP = False  # gzip saves radio time but needs ~40 KB more heap; left out until pool.stats()['heap_peak'] is measured on the device
+CACHE_FILE = 'weather.dat'
+CACHE_RECORD = '<4sI9hBB'  # magic, fetch time, Weather values, location and condition lengths
+CACHE_MAGIC = b'WTR2'
+
+# Splits the FORMAT response into lines of 'a:b:c:...' fields as the bytes arrive,
+# there is one line per requested location
+class FieldParser:
+    def __init__(self):
+        self.lines = []
+        self._fields = []
+        self._field = bytearray()
+
+    def feed(self, chunk):
+        for b in chunk:
+            if b == 0x3a:   # ':'
+                self._end_field()
+            elif b == 0x0a:  # '\n'
+                self._end_line()
+            elif b != 0x0d:
+                self._field.append(b)
+
+    def _end_field(self):
+        self._fields.append(str(self._field, 'utf-8').strip())
+        self._field = bytearray()
+
+    def _end_line(self):
+        self._end_field()
+        if len(self._fields) > 1 or self._fields[0]:
+            self.lines.append(self._fields)
+        self._fields = []
+
+    # list of field lists, one per line
+    def result(self):
+        if self._fields or self._field:
+            self._end_line()
+        return self.lines
+
+# Streaming JSON parser with bounded memory. Bytes are fed as they arrive,
+# nothing but the current path and one short scalar is kept. For every scalar
+# whose path matches one of the patterns on_value(parser, value) is called,
+# value is the raw text (strings without quotes). A pattern is a tuple of object
+# keys and '*' for any array index, e.g. ('weather', '*', 'hourly', '*', 'tempC').
+# parser.at(level) is the key or array index of the value at that level.
+_VALUE = 0      # expecting a value
+_KEY = 1        # expecting a key or '}'
+_COLON = 2      # expecting ':'
+_NEXT = 3       # after a value, expecting ',' or the end of the container
+_STRING = 4
+_ESCAPE = 5
+_LITERAL = 6
+
+class JSONStream:
+    def __init__(self, patterns, on_value, max_depth=8, max_scalar=24):
+        self._patterns = patterns
+        self._on_value = on_value
+        self._path = [None] * max_depth     # key or array index per level
+        self._arrays = bytearray(max_depth) # 1 where the level is an array
+        self._depth = 0
+        self._skip = 0                      # levels nested below max_depth
+        self._buf = bytearray(max_scalar)
+        self._n = 0
+        self._state = _VALUE
+        self._is_key = False
+        self._capture = False
+
+    def at(self, level):
+        return self._path[level]
+
+    def depth(self):
+        return self._depth
+
+    def _matches(self):
+        d = self._depth
+        if self._skip:
+            return False
+        for p in self._patterns:
+            if len(p) != d:
+                continue
+            for i in range(d):
+                if p[i] != '*' and p[i] != self._path[i]:
+                    break
+            else:
+                return True
+        return False
+
+    def _append(self, b):
+        if self._n < len(self._buf):
+            self._buf[self._n] = b
+            self._n += 1
+
+    def _push(self, is_array):
+        if self._depth == len(self._path) or self._skip:
+            self._skip += 1
+        else:
+            self._arrays[self._depth] = is_array
+            self._path[self._depth] = 0 if is_array else None
+            self._depth += 1
+
+    def _pop(self):
+        if self._skip:
+            self._skip -= 1
+        elif self._depth:
+            self._depth -= 1
+
+    def _end_value(self):
+        if self._capture:
+            self._on_value(self, str(memoryview(self._buf)[0:self._n], 'utf-8'))
+        self._capture = False
+        self._state = _NEXT
+
+    def feed(self, chunk):
+        for b in chunk:
+            state = self._state
+            if state == _STRING:
+                if b == 0x22:       # closing quote
+                    if self._is_key:
+                        if not self._skip:
+                            self._path[self._depth - 1] = str(memoryview(self._buf)[0:self._n], 'utf-8')
+                        self._state = _COLON
+                    else:
+                        self._end_value()
+                elif b == 0x5c:     # backslash
+                    self._state = _ESCAPE
+                elif self._capture or self._is_key:
+                    self._append(b)
+                continue
+            if state == _ESCAPE:
+                if self._capture or self._is_key:
+                    self._append(b)
+                self._state = _STRING
+                continue
+            if state == _LITERAL:
+                if b in b' \t\r\n,]}':
+                    self._end_value()
+                    state = _NEXT
+                else:
+                    if self._capture:
+                        self._append(b)
+                    continue
+
+            if b in b' \t\r\n':
+                continue
+
+            if state == _VALUE or state == _KEY:
+                if b == 0x22:       # '"'
+                    self._is_key = state == _KEY
+                    self._capture = not self._is_key and self._matches()
+                    self._n = 0
+                    self._state = _STRING
+                elif b == 0x7b:     # '{'
+                    self._push(0)
+                    self._state = _KEY
+                elif b == 0x5b:     # '['
+                    self._push(1)
+                    self._state = _VALUE
+                elif b == 0x7d or b == 0x5d:    # '}' ']' of an empty container
+                    self._pop()
+                    self._state = _NEXT
+                else:
+                    self._is_key = False
+                    self._capture = self._matches()
+                    self._n = 0
+                    if self._capture:
+                        self._append(b)
+                    self._state = _LITERAL
+            elif state == _COLON:
+                if b == 0x3a:
+                    self._state = _VALUE
+            elif state == _NEXT:
+                if b == 0x2c:       # ','
+                    d = self._depth
+                    if d and not self._skip and self._arrays[d - 1]:
+                        self._path[d - 1] += 1
+                        self._state = _VALUE
+                    elif self._skip or not d:
+                        self._state = _VALUE
+                    else:
+                        self._state = _KEY
+                elif b == 0x7d or b == 0x5d:
+                    self._pop()
+
+# wttr.in ?format=j1 gives 8 hourly entries per day, 3 hours apart
+FORECAST_FIELDS = ('tempC', 'chanceofrain', 'weatherCode')
+FORECAST_PATTERNS = tuple(('weather', '*', 'hourly', '*', f) for f in FORECAST_FIELDS)
+FORECAST_PER_DAY = 8
+
+# Fixed size forecast: nslots 3-hour slots starting at slot start of today
+# (start = hour // 3), values[slot * 3 + i] is FORECAST_FIELDS[i]
+class Forecast:
+    def __init__(self, nslots=4, start=0):
+        self.nslots = nslots
+        self.start = start
+        self.values = array('h', [0] * (nslots * len(FORECAST_FIELDS)))
+        self.filled = 0
+
+    def on_value(self, parser, value):
+        slot = parser.at(1) * FORECAST_PER_DAY + parser.at(3) - self.start
+        if 0 <= slot < self.nslots:
+            i = FORECAST_FIELDS.index(parser.at(4))
+            self.values[slot * len(FORECAST_FIELDS) + i] = int(value)
+            self.filled += 1
+
+    def complete(self):
+        return self.filled == len(self.values)
+
+    def temperature(self, slot):
+        return self.values[slot * 3]
+
+    def chance_of_rain(self, slot):
+        return self.values[slot * 3 + 1]
+
+    def condition_code(self, slot):
+        return self.values[slot * 3 + 2]
+
+# parse the leading signed decimal number of s, scale 10 keeps one decimal: '0.3mm' -> 3
+def _number(s, scale=1):
+    i = 0
+    sign = 1
+    if s[:1] in ('+', '-'):
+        sign = -1 if s[0] == '-' else 1
+        i = 1
+    start = i
+    n = 0
+    while i < len(s) and '0' <= s[i] <= '9':
+        n = n * 10 + ord(s[i]) - 48
+        i += 1
+    if i == start:
+        raise ValueError('not a number: ' + s)
+    if scale == 10:
+        n *= 10
+        if i + 1 < len(s) and s[i] == '.' and '0' <= s[i + 1] <= '9':
+            n += ord(s[i + 1]) - 48
+    return sign * n
+
+# indexes in Weather values
+TEMPERATURE = 0     # °C
+FEELSLIKE = 1       # °C
+HUMIDITY = 2        # %
+WIND_DIR = 3        # index in WIND_DIRECTION
+WIND_SPEED = 4      # km/h
+PRECIPITATION = 5   # tenths of a mm
+PRESSURE = 6        # hPa
+UV = 7              # UV index
+MOON = 8            # index in MOON_PHASES
+NVALUES = 9
+
+# One weather request, never changed after it's made. Weatherman swaps in a
+# new snapshot when a request succeeds, readers take weatherman.snapshot once
+# and get values of a single fetch without locking. Numbers are parsed once
+# when the answer arrives and kept in one array('h').
+class Weather:
+    __slots__ = ('fetched', 'location', 'condition', 'values')
+
+    # values: array('h') of NVALUES, fetched: time.time() of the request or 0 if unknown
+    def __init__(self, values, condition, location, fetched):
+        self.values = values
+        self.condition = condition
+        self.location = location
+        self.fetched = fetched
+
+    @property
+    def temperature(self):
+        return self.values[TEMPERATURE]
+
+    @property
+    def feelslike(self):
+        return self.values[FEELSLIKE]
+
+    @property
+    def humidity(self):
+        return self.values[HUMIDITY]
+
+    @property
+    def wind_direction(self):
+        return self.values[WIND_DIR]
+
+    @property
+    def wind_speed(self):
+        return self.values[WIND_SPEED]
+
+    @property
+    def precipitation(self):
+        return self.values[PRECIPITATION]
+
+    @property
+    def pressure(self):
+        return self.values[PRESSURE]
+
+    @property
+    def uv(self):
+        return self.values[UV]
+
+    @property
+    def moon(self):
+        return self.values[MOON]
+
+    # seconds since the request, None if unknown
+    def age(self, now=None):
+        if not self.fetched:
+            return None
+        return (time.time() if now is None else now) - self.fetched
+
+    def is_stale(self, max_age, now=None):
+        age = self.age(now)
+        return age is None or age < 0 or age > max_age
+
+    def moon_phase_text(self):
+        return MOON_PHASES_TEXT[self.moon]
+
+    def wind_text(self):
+        return f'{WIND_DIRECTION[self.wind_direction]}{self.wind_speed}km/h'
+
+    def precipitation_text(self):
+        return f'{self.precipitation // 10}.{self.precipitation % 10}mm'
+
+# Weather from the FORMAT answer split in fields, raises ValueError if it's malformed
+def parse(fields, location, fetched):
+    if len(fields) != len(NAMES):
+        raise ValueError('expected %d fields, got %d' % (len(NAMES), len(fields)))
+    temperature, feelslike, condition, humidity, wind, precipitation, pressure, uv, moon = fields
+    wind_dir = 0
+    for i in range(len(WIND_DIRECTION)):
+        if wind.startswith(WIND_DIRECTION[i]):
+            wind_dir = i
+            wind = wind[len(WIND_DIRECTION[i]):]
+            break
+    else:
+        raise ValueError('bad wind: ' + wind)
+    values = array('h', (
+        _number(temperature),
+        _number(feelslike),
+        _number(humidity),
+        wind_dir,
+        _number(wind),
+        _number(precipitation, 10),
+        _number(pressure),
+        _number(uv),
+        MOON_PHASES.index(moon),
+    ))
+    return Weather(values, condition, location, fetched)
+
+# wttr.in location in a URL
+def quote(location):
+    return location.strip().replace(' ', '+')
+
 class Weatherman:
-    _lock = None
-    _weather = {}
     _running = False
-    _location = 'Earth'
+    snapshots = {}      # location -> latest Weather
+    snapshot = None     # latest Weather of the first location
+    forecast = None
     
-    def __init__(self):
-        self._lock = _thread.allocate_lock()
+    def __init__(self, url=WTTR, cache_file=CACHE_FILE):
+        self._url = url
+        self._cache_file = cache_file
+        self.load()
+
+    # last results survive reboots in cache_file, for every location:
+    #   CACHE_RECORD followed by location and condition
+    def save(self):
+        if self._cache_file is None:
+            return
+        try:
+            tmp = self._cache_file + '.tmp'
+            with open(tmp, 'wb') as f:
+                for w in self.snapshots.values():
+                    location = w.location.encode()
+                    condition = w.condition.encode()
+                    f.write(struct.pack(CACHE_RECORD, CACHE_MAGIC, w.fetched, *w.values,
+                                        len(location), len(condition)))
+                    f.write(location)
+                    f.write(condition)
+            os.rename(tmp, self._cache_file)
+        except Exception as e:
+            print('Error in Weatherman.save:', repr(e))
+
+    def load(self):
+        if self._cache_file is None:
+            return
+        try:
+            with open(self._cache_file, 'rb') as f:
+                data = f.read()
+            snapshots = {}
+            first = None
+            n = struct.calcsize(CACHE_RECORD)
+            i = 0
+            while i < len(data):
+                record = struct.unpack(CACHE_RECORD, data[i:i + n])
+                if record[0] != CACHE_MAGIC:
+                    raise ValueError('not a weather cache')
+                i += n
+                location = str(data[i:i + record[-2]], 'utf-8')
+                i += record[-2]
+                condition = str(data[i:i + record[-1]], 'utf-8')
+                i += record[-1]
+                w = Weather(array('h', record[2:-2]), condition, location, record[1])
+                snapshots[location] = w
+                first = first or w
+            self.snapshots = snapshots
+            self.snapshot = first
+        except OSError:
+            pass
+        except Exception as e:
+            print('Error in Weatherman.load:', repr(e))
+
+    # Weather of location or None
+    def weather(self, location):
+        return self.snapshots.get(location)
         
-    def request_threadproc(self):
-        res = None
+    # fetch all locations in one request, wttr.in answers one line per location
+    # now: current time.time() or None when the clock isn't set yet
+    async def request(self, locations, now=None):
+        if isinstance(locations, str):
+            locations = [locations]
+        if self._running or not locations:
+            return False
+        self._running = True
+        gc.collect()
         try:
-            url = f'{WTTR}/{self._location}?format={FORMAT}'
-            res = requests.get(url)
-            parts = res.text.split(':')
-            with self._lock:
-                self._weather = {n:parts[i] for i,n in enumerate(NAMES)}
+            import asy_http_client
+            parser = FieldParser()
+            url = f"{self._url}/{':'.join(quote(l) for l in locations)}?{UNITS}&format={FORMAT}"
+            status = await asy_http_client.get(url, parser.feed, CONNECT_TIMEOUT_MS, READ_TIMEOUT_MS)
+            if status != 200:
+                raise OSError('HTTP status %d' % status)
+            lines = parser.result()
+            if len(lines) != len(locations):
+                raise ValueError('expected %d locations, got %d' % (len(locations), len(lines)))
+            snapshots = dict(self.snapshots)
+            updated = 0
+            for location, fields in zip(locations, lines):
+                try:
+                    snapshots[location] = parse(fields, location, now or 0)
+                    updated += 1
+                except ValueError as e:
+                    print('Error in Weatherman.request:', location, repr(e))
+            if not updated:
+                return False
+            self.snapshots = snapshots
+            self.snapshot = snapshots.get(locations[0])
+            self.save()
+            return True
         except Exception as e:
             print('Error in Weatherman.request:', repr(e))
-        
-        with self._lock:
-            self._running = False            
-    
-    def request(self, location):
+            return False
+        finally:
+            self._running = False
+
+    # fetch the j1 forecast for nslots 3-hour slots starting with slot start of today
+    async def request_forecast(self, location, nslots, start):
+        if self._running:
+            return False
+        self._running = True
         gc.collect()
-        with self._lock:
-            if not self._running:
-                self._location = location
-                self._running = True
-                _thread.start_new_thread(self.request_threadproc, ())
-                return True
-        return False
-    
-    def get(self, key):
-        with self._lock:
-            try:
-                return self._weather[key]
-            except:
-                return None
-            
-    def get_moon_phase_text(self):
         try:
-            unicode = self.get('moon')
-            i = MOON_PHASES.index(unicode)
-            return MOON_PHASES_TEXT[i]
-        except:
-            return None        
+            import asy_http_client
+            forecast = Forecast(nslots, start)
+            parser = JSONStream(FORECAST_PATTERNS, forecast.on_value)
+            url = f'{self._url}/{quote(location)}?format=j1'
+            status = await asy_http_client.get(url, parser.feed, CONNECT_TIMEOUT_MS, READ_TIMEOUT_MS, FORECAST_GZIP)
+            if status != 200:
+                raise OSError('HTTP status %d' % status)
+            if not forecast.complete():
+                raise ValueError('incomplete forecast')
+            self.forecast = forecast
+            return True
+        except Exception as e:
+            print('Error in Weatherman.request_forecast:', repr(e))
+            return False
+        finally:
+            self._running = False
+
+    def get_moon_phase_text(self):
+        w = self.snapshot
+        return None if w is None else w.moon_phase_text()
     
     def isrunning(self):
-        with self._lock:
-            return self._running
+        return self._running
+
+
+# Check the forecast parser on the host with a recorded document, asy_http_client
+# (and with it uasyncio) is only imported by the Weatherman requests:
+#   curl -o paris.json 'https://wttr.in/Paris?format=j1'
+#   python3 wttrin.py paris.json
+if __name__ == '__main__':
+    import sys
+    forecast = Forecast(FORECAST_PER_DAY * 3)
+    parser = JSONStream(FORECAST_PATTERNS, forecast.on_value)
+    with open(sys.argv[1], 'rb') as f:
+        while True:
+            chunk = f.read(256)
+            if not chunk:
+                break
+            parser.feed(chunk)
+    for slot in range(forecast.nslots):
+        print('day %d %02d:00 %3d°C rain %3d%% code %d' % (
+            slot // FORECAST_PER_DAY, slot % FORECAST_PER_DAY * 3,
+            forecast.temperature(slot), forecast.chance_of_rain(slot), forecast.condition_code(slot)))
+    print('complete' if forecast.complete() else 'INCOMPLETE')